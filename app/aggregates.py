@@ -0,0 +1,130 @@
+"""
+    Aggregates of the data values of a question, built once by the DataIngestor
+    and shared by every task that asks about the same question.
+"""
+
+import copy
+
+import numpy as np
+
+def add(stats: tuple, other: tuple) -> tuple:
+    """
+        Return the (sum, count) pair of the union of two groups of values.
+    """
+    return stats[0] + other[0], stats[1] + other[1]
+
+def mean(stats: tuple) -> float:
+    """
+        Return the mean behind a (sum, count) pair, as a Python float rather than
+        an np.float64, so the results take the fast path of the JSON encoders.
+    """
+    return float(stats[0] / stats[1])
+
+class QuestionAggregate:
+    """
+        Sums and counts of the data values of a question, kept per question,
+        per state and per (state, stratification category, stratification value).
+
+        The sums are computed with np.sum over the values in csv order, so the
+        means are exactly the ones np.mean would return over the same rows.
+    """
+
+    def __init__(self, data_ingestor, question: str):
+        rows = data_ingestor.question_slice(question)
+        self.total = self.stats(data_ingestor.values[rows])
+
+        # States are kept in order of first appearance in the csv
+        self.states = {
+            state: self.stats(data_ingestor.values[state_rows])
+            for state, state_rows in data_ingestor.state_slices(question).items()
+        }
+
+        self.categories = {state: {} for state in self.states}
+        self.add_categories(data_ingestor, rows)
+
+        self.derive()
+
+    def derive(self):
+        """
+            Compute, in one pass over the sums, every statistic the tasks are built from:
+            the global mean, the state means (in csv order and ranked both ways) and
+            the category means of every state, sorted by (category, category value).
+        """
+        # An empty question has a NaN global mean, like np.mean of no values
+        with np.errstate(invalid="ignore"):
+            self.global_mean = mean(self.total)
+
+        self.state_means = {state: mean(stats) for state, stats in self.states.items()}
+        self.states_ascending = sorted(self.state_means.items(), key=lambda x: x[1])
+        self.states_descending = sorted(self.state_means.items(), key=lambda x: x[1],
+                                        reverse=True)
+
+        self.category_means = {
+            state: sorted(((key, mean(stats)) for key, stats in categories.items()),
+                          key=lambda x: x[0])
+            for state, categories in self.categories.items()
+        }
+        self.all_category_means = [
+            ((state,) + key, category_mean)
+            for state in sorted(self.category_means)
+            for key, category_mean in self.category_means[state]
+        ]
+
+    def merge(self, other: "QuestionAggregate") -> "QuestionAggregate":
+        """
+            Return the aggregate of the rows of both aggregates, adding up their sums
+            and counts. The states and categories only found in other come last,
+            as they appear later in the data.
+        """
+        merged = copy.copy(self)
+        merged.total = add(self.total, other.total)
+
+        merged.states = dict(self.states)
+        for state, stats in other.states.items():
+            merged.states[state] = add(merged.states.get(state, (0.0, 0)), stats)
+
+        merged.categories = {state: dict(categories)
+                             for state, categories in self.categories.items()}
+        for state, categories in other.categories.items():
+            state_categories = merged.categories.setdefault(state, {})
+            for key, stats in categories.items():
+                state_categories[key] = add(state_categories.get(key, (0.0, 0)), stats)
+
+        merged.derive()
+        return merged
+
+    @staticmethod
+    def stats(values: np.ndarray) -> tuple:
+        """
+            Return the (sum, count) pair of the given values.
+        """
+        return np.sum(values), len(values)
+
+    def add_categories(self, data_ingestor, rows: slice):
+        """
+            Group the rows by (state, category, category value) in a single pass,
+            skipping the rows without a stratification category.
+        """
+        columns = (data_ingestor.state[rows], data_ingestor.category[rows],
+                   data_ingestor.category_value[rows], data_ingestor.values[rows])
+
+        if "" in data_ingestor.categories:
+            keep = columns[1] != data_ingestor.categories.codes[""]
+            columns = tuple(column[keep] for column in columns)
+
+        # A stable sort keeps the rows of each group in csv order
+        keys = ((columns[0].astype(np.int64) * len(data_ingestor.categories)
+                + columns[1]) * len(data_ingestor.category_values) + columns[2])
+        order = np.argsort(keys, kind="stable")
+        states, categories, category_values, values = (column[order] for column in columns)
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+
+        for start, stop in zip(np.r_[0, bounds].tolist(), np.r_[bounds, len(keys)].tolist()):
+            if start == stop:
+                continue
+
+            state = data_ingestor.states.decode(int(states[start]))
+            key = (data_ingestor.categories.decode(int(categories[start])),
+                   data_ingestor.category_values.decode(int(category_values[start])))
+
+            self.categories[state][key] = self.stats(values[start:stop])
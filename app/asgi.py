@@ -0,0 +1,231 @@
+"""
+    ASGI entry point of the webserver, served by an ASGI server such as uvicorn
+    (see asgi_server.py).
+
+    The result polls of /api/get_results are answered on the event loop: a ?wait=
+    long poll is a coroutine parked on a future, which the worker that finishes
+    the job resolves, so idle connections don't hold a thread each. Every other
+    route is handed over to the Flask app, on a small pool of threads.
+"""
+
+import asyncio
+import io
+import os
+import re
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from app.webserver import webserver as ws
+from app.routes import MAX_WAIT_SECONDS, parse_job_id, job_result
+from app.serialization import compress, response_headers
+from app.result_store import FileResultStore
+
+GET_RESULTS_PATH = re.compile(r"^/api/get_results/([^/]+)$")
+GET_RESULTS_ROUTE = "/api/get_results/<job_id>"
+
+def create_wsgi_executor() -> ThreadPoolExecutor:
+    """
+        Create the threads that run the Flask routes, ASGI_WSGI_THREADS of them
+        (by default as many as ThreadPoolExecutor picks).
+    """
+    try:
+        return ThreadPoolExecutor(int(os.getenv("ASGI_WSGI_THREADS")),
+                                  thread_name_prefix="wsgi")
+    except TypeError:
+        return ThreadPoolExecutor(thread_name_prefix="wsgi")
+
+wsgi_executor = create_wsgi_executor()
+
+async def application(scope: dict, receive, send):
+    """
+        The ASGI application.
+    """
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] != "http":
+        return
+
+    match = GET_RESULTS_PATH.match(scope["path"])
+    if match is not None and scope["method"] == "GET":
+        await get_results(scope, send, match.group(1))
+    else:
+        await call_flask(scope, receive, send)
+
+async def lifespan(receive, send):
+    """
+        Answer the startup and shutdown events of the server, stopping the
+        workers on shutdown.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            ws.tasks_runner.graceful_shutdown()
+            wsgi_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def get_results(scope: dict, send, job_id: str):
+    """
+        Serve /api/get_results/<job_id> on the event loop, like routes.get_response.
+    """
+    started_at = time.monotonic()
+    parsed_job_id = parse_job_id(job_id)
+
+    try:
+        wait = float(parse_qs(scope["query_string"].decode("latin-1"))["wait"][0])
+    except (KeyError, ValueError):
+        wait = None
+
+    if parsed_job_id is not None and wait is not None and wait > 0:
+        await wait_for_job(parsed_job_id, min(wait, MAX_WAIT_SECONDS))
+
+    if answer_blocks():
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(wsgi_executor, job_result, job_id, parsed_job_id)
+    else:
+        body = job_result(job_id, parsed_job_id)
+
+    accept_encoding = ",".join(value.decode("latin-1") for name, value in scope["headers"]
+                               if name.lower() == b"accept-encoding")
+    body, coding = compress(body, accept_encoding)
+    headers = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+               for name, value in response_headers(coding).items()]
+    await send_response(send, 200, headers, body)
+
+    ws.requests.inc(GET_RESULTS_ROUTE, "GET", "200")
+    ws.request_duration.observe(time.monotonic() - started_at, GET_RESULTS_ROUTE)
+
+def answer_blocks() -> bool:
+    """
+        Check if answering a poll may block on file I/O: when the results are read
+        from files (RESULT_STORE=file or a spill directory) or the log is written
+        by the request threads (LOG_MODE=sync). The poll is then answered on one of
+        the wsgi threads instead of the event loop.
+    """
+    store = ws.tasks_runner.result_store
+    return (isinstance(store, FileResultStore) or getattr(store, "spill", None) is not None
+            or os.getenv("LOG_MODE") == "sync")
+
+async def wait_for_job(job_id: int, timeout: float):
+    """
+        Wait until the job is no longer running or the timeout (in seconds) expires,
+        without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    def resolve():
+        if not finished.done():
+            finished.set_result(None)
+
+    def wake_up():
+        # Called from the worker thread that finished the job
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            pass # the loop was closed in the meantime
+
+    if not ws.tasks_runner.add_job_waiter(job_id, wake_up):
+        return
+
+    try:
+        await asyncio.wait_for(finished, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        # Also when the request is cancelled, e.g. because the client went away
+        ws.tasks_runner.remove_job_waiter(job_id, wake_up)
+
+async def call_flask(scope: dict, receive, send):
+    """
+        Serve the request with the Flask app, on one of the wsgi threads.
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+
+    environ = build_environ(scope, bytes(body))
+    loop = asyncio.get_running_loop()
+    status, headers, payload = await loop.run_in_executor(wsgi_executor, call_wsgi, environ)
+    await send_response(send, status, headers, payload)
+
+def build_environ(scope: dict, body: bytes) -> dict:
+    """
+        Build the WSGI environ of an ASGI http request.
+    """
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    return environ
+
+def call_wsgi(environ: dict) -> tuple:
+    """
+        Call the Flask app and return the status code, headers and body of its response.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None): # pylint: disable=unused-argument
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                               for name, value in headers]
+
+    chunks = ws.wsgi_app(environ, start_response)
+    try:
+        payload = b"".join(chunks)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+    return response["status"], response["headers"], payload
+
+async def send_response(send, status: int, headers: list, payload: bytes):
+    """
+        Send a complete response.
+    """
+    if not any(name == b"content-length" for name, _ in headers):
+        headers = headers + [(b"content-length", str(len(payload)).encode("latin-1"))]
+
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": payload})
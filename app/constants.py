@@ -14,6 +14,9 @@ MEAN_BY_CATEGORY = 8
 STATE_MEAN_BY_CATEGORY = 9
 GRACEFUL_SHUTDOWN = 10
 
+# Tasks that take the "state" field of the request into account
+STATE_TASKS = (STATE_MEAN, STATE_DIFF_FROM_MEAN, STATE_MEAN_BY_CATEGORY)
+
 def get_task_constants():
     """
         Returns the task constants.
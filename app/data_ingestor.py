@@ -1,17 +1,93 @@
 """
     DataIngestor class is responsible for reading data from a csv file and storing
-    it in a dictionary for easy access.
+    it in a columnar, NumPy-backed layout for easy access.
 """
 
+import copy
 import csv
+import logging
+
+from array import array
+from contextlib import ExitStack
+from threading import Lock
+
+import numpy as np
+
+from .aggregates import QuestionAggregate
+from .snapshot import DICTIONARIES, load_snapshot, save_snapshot, snapshot_lock
+
+logger = logging.getLogger(__name__)
+
+# Csv column and array typecode of every feature kept by the data ingestor
+CSV_FEATURES = {
+    "values": ("Data_Value", "d"),
+    "year_start": ("YearStart", "h"),
+    "year_end": ("YearEnd", "h"),
+    "question": ("Question", "i"),
+    "state": ("LocationDesc", "i"),
+    "category": ("StratificationCategory1", "i"),
+    "category_value": ("Stratification1", "i"),
+}
+
+def new_buffers() -> dict:
+    """
+        Return empty typed buffers, one per feature, to append rows to.
+    """
+    return {name: array(typecode) for name, (_, typecode) in CSV_FEATURES.items()}
+
+def buffer_columns(buffers: dict) -> dict:
+    """
+        View the filled buffers as NumPy columns, without copying them.
+    """
+    return {name: np.frombuffer(buffer, dtype=buffer.typecode) for name, buffer in buffers.items()}
+
+class StringDictionary:
+    """
+        Dictionary encoding for a string column: every distinct string is mapped
+        to a small integer code, in order of first appearance.
+    """
+
+    def __init__(self, values: list = None):
+        self.values = []
+        self.codes = {}
+
+        for value in values or []:
+            self.encode(value)
+
+    def encode(self, value: str) -> int:
+        """
+            Return the code of the given string, assigning a new one if needed.
+        """
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def decode(self, code: int) -> str:
+        """
+            Return the string behind the given code.
+        """
+        return self.values[code]
+
+    def __contains__(self, value: str) -> bool:
+        return value in self.codes
+
+    def __len__(self) -> int:
+        return len(self.values)
 
 class DataIngestor:
     """
         DataIngestor class is responsible for reading data from a csv file and storing
-        it in a dictionary for easy access.
+        it as typed columns, grouped by question and then by state.
+
+        Rows of a question live in the contiguous range given by question_offsets and,
+        inside it, rows of a state form a contiguous run (see state_slices), so every
+        task works on slices of the columns instead of parsing strings.
     """
 
-    def __init__(self, csv_path: str):
+    def __init__(self, csv_path: str, snapshot_dir: str = None):
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
             'Percent of adults aged 18 years and older who have obesity',
@@ -35,39 +111,240 @@ class DataIngestor:
  a week',
         ]
 
-        self.process_csv_data(csv_path)
+        # Dictionaries for the integer-coded columns
+        self.questions = StringDictionary(self.questions_best_is_max + self.questions_best_is_min)
+        self.states = StringDictionary()
+        self.categories = StringDictionary()
+        self.category_values = StringDictionary()
+
+        # Aggregates are built lazily, the first time a question is asked about
+        self.aggregates = {}
+        self.aggregates_lock = Lock()
+
+        # Rows appended after the csv was ingested, one data ingestor per append
+        self.segments = []
+
+        # With a snapshot directory, the csv is parsed only if it changed since the
+        # last snapshot was written, and the columns are then mapped from the snapshot
+        # so they are shared with the other server processes
+        if snapshot_dir is None:
+            self.process_csv_data(csv_path)
+            return
+
+        # The snapshot is only a cache: if it can't be written, the columns parsed
+        # from the csv are kept in memory
+        with ExitStack() as stack:
+            try:
+                stack.enter_context(snapshot_lock(csv_path, snapshot_dir))
+            except OSError as e:
+                logger.warning(f"Can't lock the snapshot of {csv_path} - {e}")
+                self.process_csv_data(csv_path)
+                return
+
+            if load_snapshot(self, csv_path, snapshot_dir):
+                return
 
-    def select_import_features(self, entry: dict) -> dict:
+            self.process_csv_data(csv_path)
+            try:
+                save_snapshot(self, csv_path, snapshot_dir)
+            except OSError as e:
+                logger.warning(f"Can't write the snapshot of {csv_path} - {e}")
+                return
+            load_snapshot(self, csv_path, snapshot_dir)
+
+    def __getstate__(self) -> dict:
+        # The lock can't be pickled, e.g. when a worker process is spawned
+        state = self.__dict__.copy()
+        del state["aggregates_lock"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.aggregates_lock = Lock()
+
+    def process_csv_data(self, csv_path:str):
         """
-            Select the important features from the entry and return them as a dictionary
+            Stream the given csv and store the important features as columns.
+
+            Only the needed fields of every row are kept, appended to compact typed
+            buffers as the rows are read, so the peak memory stays close to the size
+            of the final columns instead of holding the whole csv.
         """
+        buffers = new_buffers()
 
-        return {
-            "YearStart": entry["YearStart"],
-            "YearEnd": entry["YearEnd"],
-            "DataValue": entry["Data_Value"],
-            "LocationAbbr": entry["LocationAbbr"],
-            "LocationDesc": entry["LocationDesc"],
-            "StratificationCategory1": entry["StratificationCategory1"],
-            "Stratification1": entry["Stratification1"],
+        with open(csv_path, 'r', encoding='utf-8', newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            indices = [header.index(csv_name) for csv_name, _ in CSV_FEATURES.values()]
+
+            for entry in reader:
+                # Blank lines are skipped, as csv.DictReader does
+                if not entry:
+                    continue
+                if len(entry) < len(header):
+                    raise ValueError(f"Line {reader.line_num} of {csv_path} has "
+                                     f"{len(entry)} fields instead of {len(header)}")
+                self.append_row(buffers, [entry[index] for index in indices])
+
+        self.build_columns(buffer_columns(buffers))
+
+    def append_row(self, buffers: dict, fields: list):
+        """
+            Encode the fields of a row, ordered like CSV_FEATURES, into the column buffers.
+        """
+        value, year_start, year_end, question, state, category, category_value = fields
+
+        buffers["values"].append(float(value))
+        buffers["year_start"].append(int(year_start))
+        buffers["year_end"].append(int(year_end))
+        buffers["question"].append(self.questions.encode(question))
+        buffers["state"].append(self.states.encode(state))
+        buffers["category"].append(self.categories.encode(category))
+        buffers["category_value"].append(self.category_values.encode(category_value))
+
+    def build_columns(self, columns: dict):
+        """
+            Lay the columns out grouped by question and then by state (in order of first
+            appearance of the state in the question) and compute the offsets.
+        """
+        questions, states = columns["question"], columns["state"]
+
+        # Rows ordered by question, then by the first row of their (question, state)
+        # pair; the sort is stable, so the rows of a state stay in csv order
+        pairs = questions.astype(np.int64) * len(self.states) + states
+        _, first_rows, pair_ids = np.unique(pairs, return_index=True, return_inverse=True)
+        order = np.lexsort((first_rows[pair_ids], questions))
+
+        self.question_offsets = np.zeros(len(self.questions) + 1, dtype=np.int64)
+        self.question_offsets[1:] = np.cumsum(np.bincount(questions, minlength=len(self.questions)))
+
+        self.state_offsets = [{} for _ in range(len(self.questions))]
+        bounds = (np.flatnonzero(np.diff(pair_ids[order])) + 1).tolist()
+        for start, stop in zip([0] + bounds, bounds + [len(order)]):
+            if start < stop:
+                row = order[start]
+                self.state_offsets[questions[row]][int(states[row])] = (start, stop)
+
+        self.values = columns["values"].astype(np.float64)[order]
+        self.year_start = columns["year_start"].astype(np.int16)[order]
+        self.year_end = columns["year_end"].astype(np.int16)[order]
+        self.question = questions.astype(np.int32)[order]
+        self.state = states.astype(np.int32)[order]
+        self.category = columns["category"].astype(np.int32)[order]
+        self.category_value = columns["category_value"].astype(np.int32)[order]
+
+    def append_csv(self, csv_path: str) -> "DataIngestor":
+        """
+            Return a data ingestor with the rows of a delta csv, with the same columns
+            as the dataset, appended (see append_rows).
+        """
+        with open(csv_path, 'r', encoding='utf-8', newline='') as file:
+            return self.append_rows(csv.DictReader(file))
+
+    def append_rows(self, rows) -> "DataIngestor":
+        """
+            Return a data ingestor with the given rows, as dicts keyed by csv column
+            name, appended for existing or new questions and states. This one is left
+            untouched, so the tasks still running against it are not affected.
+
+            The new rows are encoded into a segment of their own, laid out like the
+            dataset, and the columns of the dataset are shared rather than copied
+            (they stay memory-mapped if they come from a snapshot). The aggregates
+            already built are updated with the sums and counts of the segment, so the
+            tasks remain lookups after the append.
+        """
+        delta = copy.copy(self)
+        delta.aggregates = {}
+        delta.segments = []
+        for name in DICTIONARIES:
+            setattr(delta, name, copy.deepcopy(getattr(self, name)))
+
+        buffers = new_buffers()
+        for row in rows:
+            delta.append_row(buffers, [row[csv_name] for csv_name, _ in CSV_FEATURES.values()])
+        delta.build_columns(buffer_columns(buffers))
+
+        # The codes of the known strings are unchanged in the extended dictionaries
+        appended = copy.copy(self)
+        appended.aggregates_lock = Lock()
+        appended.segments = self.segments + [delta]
+        for name in DICTIONARIES:
+            setattr(appended, name, getattr(delta, name))
+
+        with self.aggregates_lock:
+            aggregates = dict(self.aggregates)
+
+        appended.aggregates = {
+            question: aggregate.merge(QuestionAggregate(delta, question))
+            if delta.has_rows(question) else aggregate
+            for question, aggregate in aggregates.items()
         }
+        return appended
 
-    def process_csv_data(self, csv_path:str):
+    def has_question(self, question: str) -> bool:
         """
-            Read data from the given csv and store the important features in the data dictionary
+            Check if the given question is known to the data ingestor.
         """
-        with open(csv_path, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            csv_data = list(reader)
+        return question in self.questions
 
-        self.data = {q: {} for q in self.questions_best_is_max + self.questions_best_is_min}
+    def has_rows(self, question: str) -> bool:
+        """
+            Check if the columns of this data ingestor, without its appended segments,
+            hold rows of the given question.
+        """
+        code = self.questions.codes.get(question)
+        if code is None or code + 1 >= len(self.question_offsets):
+            return False
+        return bool(self.question_offsets[code + 1] > self.question_offsets[code])
 
-        for entry in csv_data:
-            important_data = self.select_import_features(entry)
+    def question_slice(self, question: str) -> slice:
+        """
+            Return the slice of rows that belong to the given question.
+        """
+        code = self.questions.codes[question]
+        return slice(int(self.question_offsets[code]), int(self.question_offsets[code + 1]))
 
-            loc_d = entry["LocationDesc"]
+    def state_slices(self, question: str) -> dict:
+        """
+            Return the slices of rows of the given question for each state,
+            in order of first appearance of the state in the csv.
+        """
+        code = self.questions.codes[question]
+        return {
+            self.states.decode(state): slice(start, stop)
+            for state, (start, stop) in self.state_offsets[code].items()
+        }
+
+    def build_aggregates(self):
+        """
+            Build the aggregates of every question upfront.
+        """
+        for question in self.questions.values:
+            self.aggregate(question)
+
+    def aggregate(self, question: str) -> QuestionAggregate:
+        """
+            Return the aggregates of the given question, building them on first use.
+        """
+        aggregate = self.aggregates.get(question)
+        if aggregate is None:
+            with self.aggregates_lock:
+                aggregate = self.aggregates.get(question)
+                if aggregate is None:
+                    aggregate = self.build_aggregate(question)
+                    self.aggregates[question] = aggregate
+        return aggregate
+
+    def build_aggregate(self, question: str) -> QuestionAggregate:
+        """
+            Aggregate the rows of the given question, in the columns of the dataset
+            and then in every appended segment.
+        """
+        aggregate = None
+        for part in [self] + self.segments:
+            if part.has_rows(question):
+                part_aggregate = QuestionAggregate(part, question)
+                aggregate = part_aggregate if aggregate is None else aggregate.merge(part_aggregate)
 
-            if loc_d not in self.data[entry["Question"]]:
-                self.data[entry["Question"]][loc_d] = [important_data]
-            else:
-                self.data[entry["Question"]][loc_d].append(important_data)
+        # A known question without rows still gets its (empty) aggregate
+        return aggregate if aggregate is not None else QuestionAggregate(self, question)
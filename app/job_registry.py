@@ -0,0 +1,161 @@
+"""
+    Registry of the status of every job, indexed by job_id.
+"""
+
+import os
+import time
+
+from collections import deque
+from threading import Lock
+
+# Statuses of the jobs, stored as one byte per job
+STATUSES = ("expired", "running", "done", "error")
+EXPIRED, RUNNING, DONE, ERROR = (bytes([code]) for code in range(len(STATUSES)))
+
+class JobRegistry:
+    """
+        Compact registry of the jobs: the status of every job is a byte in a bytearray
+        indexed by job_id - base, and only the failed jobs keep their reason, in a dict.
+
+        A finished job expires retention seconds after it finished. Once the oldest
+        jobs have all expired, they are cut from the front of the array, so the memory
+        stays bounded by the jobs of the last retention seconds (and the ones still
+        running). The running jobs are counted as they change status.
+    """
+
+    def __init__(self, retention: float):
+        self.retention = retention
+
+        self.base = 0 # job_id of the first job in statuses
+        self.statuses = bytearray()
+        self.reasons = {} # job_id -> reason, for the failed jobs
+        self.finished = deque() # (expiry time, job_id), in order of expiry
+        self.expired = 0 # expired jobs still in statuses
+        self.running = 0
+        self.lock = Lock()
+
+    @property
+    def next_id(self) -> int:
+        """
+            The job_id of the next job.
+        """
+        return self.base + len(self.statuses)
+
+    def __len__(self) -> int:
+        return len(self.statuses) - self.expired
+
+    def create(self) -> int:
+        """
+            Register a new running job and return its job_id.
+        """
+        with self.lock:
+            self.expire()
+            self.statuses += RUNNING
+            self.running += 1
+            return self.next_id - 1
+
+    def __getitem__(self, job_id: int) -> dict:
+        with self.lock:
+            if not 0 <= job_id < self.next_id:
+                raise KeyError(job_id)
+
+            status = STATUSES[self.status_code(job_id)]
+            if status == "error":
+                return {"status": status, "reason": self.reasons[job_id]}
+            return {"status": status}
+
+    def __setitem__(self, job_id: int, job: dict):
+        with self.lock:
+            previous = self.status_code(job_id)
+            code = STATUSES.index(job["status"])
+            if previous == code or previous == EXPIRED[0]:
+                return
+
+            self.statuses[job_id - self.base] = code
+            if code == ERROR[0]:
+                self.reasons[job_id] = job["reason"]
+
+            # A job only moves from running to finished
+            self.running -= 1
+            self.finished.append((time.monotonic() + self.retention, job_id))
+            self.expire()
+
+    def status_code(self, job_id: int) -> int:
+        """
+            Return the status code of the job, with the lock held.
+        """
+        if job_id < self.base:
+            return EXPIRED[0]
+        return self.statuses[job_id - self.base]
+
+    def expire(self):
+        """
+            Expire the jobs that finished more than retention seconds ago and cut the
+            expired jobs from the front of the array, with the lock held.
+        """
+        now = time.monotonic()
+        while self.finished and self.finished[0][0] <= now:
+            _, job_id = self.finished.popleft()
+            self.statuses[job_id - self.base] = EXPIRED[0]
+            self.reasons.pop(job_id, None)
+            self.expired += 1
+
+        # Cutting the front copies the array, so it is only done once at least
+        # half of it has expired, which keeps the cost amortized constant per job
+        if self.statuses[:1] == EXPIRED and self.expired * 2 >= len(self.statuses):
+            statuses = self.statuses.lstrip(EXPIRED)
+            dropped = len(self.statuses) - len(statuses)
+
+            self.statuses = bytearray(statuses)
+            self.base += dropped
+            self.expired -= dropped
+
+    def page(self, start: int, limit: int, status: str = None) -> tuple:
+        """
+            Return up to limit (job_id, status) pairs of the jobs from start onwards,
+            optionally only those with the given status, and the job_id to start the
+            next page from (None on the last page). Expired jobs are left out.
+        """
+        with self.lock:
+            self.expire()
+
+            position = max(start - self.base, 0)
+            jobs = []
+
+            if status is None:
+                while len(jobs) < limit and position < len(self.statuses):
+                    if self.statuses[position] != EXPIRED[0]:
+                        jobs.append((self.base + position, STATUSES[self.statuses[position]]))
+                    position += 1
+
+                more = position < len(self.statuses)
+            else:
+                # Jump from one job with the wanted status to the next
+                code = STATUSES.index(status)
+                while len(jobs) < limit:
+                    found = self.statuses.find(code, position)
+                    if found == -1:
+                        position = len(self.statuses)
+                        break
+
+                    jobs.append((self.base + found, status))
+                    position = found + 1
+
+                more = self.statuses.find(code, position) != -1
+
+            return jobs, self.base + position if more else None
+
+def create_job_registry() -> JobRegistry:
+    """
+        Create the job registry, keeping the finished jobs for JOB_RETENTION seconds
+        (by default as long as the results are kept, see RESULT_STORE_TTL).
+    """
+    try:
+        retention = float(os.getenv("JOB_RETENTION"))
+    except TypeError:
+        try:
+            retention = float(os.getenv("RESULT_STORE_TTL"))
+        except TypeError:
+            retention = 3600.0
+
+    return JobRegistry(retention)
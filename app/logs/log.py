@@ -1,9 +1,13 @@
 """ This module contains the log configuration for the input/output of application's routes."""
 
+import atexit
+import itertools
 import logging
+import os
+import queue
 import time
 
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 class UTCConverter(logging.Formatter):
     """
@@ -29,14 +33,60 @@ class UTCConverter(logging.Formatter):
             date_format='%Y-%m-%d %H:%M:%S %z'
         )
 
+class AsyncQueueHandler(QueueHandler):
+    """
+        Queue handler that leaves the formatting of the records to the listener thread,
+        so the request threads only put the record in the queue. When the queue is full
+        the record is dropped (and counted) instead of blocking the request.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The records never leave the process, so they don't need to be formatted
+        # and stripped of their arguments before being queued
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class SamplingFilter(logging.Filter):
+    """
+        Keep only one in every rate records logged with extra={"sampled": True},
+        e.g. the high-volume "running" answers to result polls.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = max(rate, 1)
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False):
+            return True
+        return next(self.counter) % self.rate == 0
+
+def get_env_int(name, default):
+    """
+        Get an integer setting from the environment.
+    """
+    try:
+        return int(os.getenv(name))
+    except TypeError:
+        return default
+
 def get_rotating_file_handler():
     """
-        Get the rotating file handler.
+        Get the rotating file handler, rotating every LOG_MAX_BYTES (10 MB by default)
+        and keeping LOG_BACKUP_COUNT old files.
     """
     return RotatingFileHandler(
         "app/logs/webserver.log",
-        maxBytes=5000,
-        backupCount=7
+        maxBytes=get_env_int("LOG_MAX_BYTES", 10 * 1024 * 1024),
+        backupCount=get_env_int("LOG_BACKUP_COUNT", 7)
     )
 
 def instantiate_logger():
@@ -51,6 +101,20 @@ def instantiate_logger():
 
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
-    logger.addHandler(handler)
+
+    # LOG_MODE=sync writes from the request threads; by default, the records are
+    # queued and a listener thread formats and writes them
+    if os.getenv("LOG_MODE", "async") == "sync":
+        logger.addHandler(handler)
+    else:
+        queue_handler = AsyncQueueHandler(queue.Queue(get_env_int("LOG_QUEUE_SIZE", 10000)))
+        listener = QueueListener(queue_handler.queue, handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+        handler = queue_handler
+        logger.addHandler(handler)
+
+    handler.addFilter(SamplingFilter(get_env_int("LOG_SAMPLE_RATE", 1)))
 
     return logger
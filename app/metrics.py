@@ -0,0 +1,154 @@
+"""
+    Counters and histograms of the server, exposed by /metrics in the Prometheus
+    text exposition format.
+"""
+
+from threading import Lock
+
+# Upper bounds (in seconds) of the histogram buckets, as used by the Prometheus clients
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    """
+        Format the labels of a sample, e.g. {task="best5",le="0.1"}.
+    """
+    if not label_names:
+        return ""
+
+    labels = ",".join(
+        f'{name}="{escape_label(value)}"' for name, value in zip(label_names, label_values)
+    )
+    return "{" + labels + "}"
+
+def escape_label(value) -> str:
+    """
+        Escape a label value: backslashes, double quotes and line feeds.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_value(value: float) -> str:
+    """
+        Format a sample value, writing the integral ones without a fractional part.
+    """
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def header(name: str, documentation: str, metric_type: str) -> list:
+    """
+        Return the HELP and TYPE lines of a metric.
+    """
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+
+def gauge(name: str, documentation: str, samples: dict, label_names: tuple = (),
+          metric_type: str = "gauge") -> list:
+    """
+        Render a metric whose samples (label values -> value) are read at scrape time,
+        e.g. a gauge, or a counter kept by another object.
+    """
+    lines = header(name, documentation, metric_type)
+    for label_values, value in samples.items():
+        lines.append(f"{name}{format_labels(label_names, label_values)} {format_value(value)}")
+    return lines
+
+class Counter:
+    """
+        Monotonic counter, with one value per combination of label values.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+
+        self.values = {} # label values -> count
+        self.lock = Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        """
+            Add amount to the counter of the given label values.
+        """
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        """
+            Return the lines of the counter in the text exposition format.
+        """
+        with self.lock:
+            values = dict(self.values)
+
+        lines = header(self.name, self.documentation, "counter")
+        for label_values, value in sorted(values.items()):
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}{labels} {format_value(value)}")
+        return lines
+
+class Histogram:
+    """
+        Histogram of observed durations, with cumulative buckets, a sum and a count
+        for every combination of label values.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+
+        # label values -> [count per bucket (not cumulative), sum, count]
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, *label_values):
+        """
+            Record an observation for the given label values.
+        """
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self.values[label_values] = series
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+
+            series[1] += value
+            series[2] += 1
+
+    def totals(self) -> tuple:
+        """
+            Return the (sum, count) of the observations of all the label values.
+        """
+        with self.lock:
+            return (sum(total for _, total, _ in self.values.values()),
+                    sum(count for _, _, count in self.values.values()))
+
+    def render(self) -> list:
+        """
+            Return the lines of the histogram in the text exposition format.
+        """
+        with self.lock:
+            values = {key: (list(counts), total, count)
+                      for key, (counts, total, count) in self.values.items()}
+
+        label_names = self.label_names + ("le",)
+        lines = header(self.name, self.documentation, "histogram")
+
+        for label_values, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(label_names, label_values + (format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = format_labels(label_names, label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
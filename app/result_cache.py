@@ -0,0 +1,74 @@
+"""
+    Cache of serialized task results, so identical requests are answered without
+    being computed again.
+"""
+
+import os
+
+from collections import OrderedDict
+from threading import Lock
+
+class ResultCache:
+    """
+        Bounded LRU cache from a normalized task key to its serialized result.
+
+        The dataset is immutable between reloads, so the entries never go stale
+        on their own and only need to be dropped through invalidate().
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> payload, least recently used first
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: tuple):
+        """
+            Return the serialized result cached for the key or None on a miss.
+        """
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return payload
+
+    def put(self, key: tuple, payload: bytes):
+        """
+            Cache the serialized result of the key, evicting the least recently used one.
+        """
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = payload
+            self.entries.move_to_end(key)
+
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        """
+            Drop every cached result, e.g. after the dataset was reloaded.
+        """
+        with self.lock:
+            self.entries.clear()
+
+def create_result_cache() -> ResultCache:
+    """
+        Create the result cache, bounded to RESULT_CACHE_SIZE entries (0 disables it).
+    """
+    try:
+        max_entries = int(os.getenv("RESULT_CACHE_SIZE"))
+    except TypeError:
+        max_entries = 1024
+
+    return ResultCache(max_entries)
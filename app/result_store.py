@@ -0,0 +1,136 @@
+"""
+    Result stores keep the serialized result of every finished job until it is
+    requested through /api/get_results.
+"""
+
+import os
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+class FileResultStore:
+    """
+        Result store that writes every result to results/<job_id>, one file per job.
+    """
+
+    def __init__(self, directory: str = "results"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, job_id: int, payload: bytes):
+        """
+            Store the serialized result of the given job.
+        """
+        with open(os.path.join(self.directory, str(job_id)), "wb") as f:
+            f.write(payload)
+
+    def get(self, job_id: int):
+        """
+            Return the serialized result of the given job or None if there is none.
+        """
+        try:
+            with open(os.path.join(self.directory, str(job_id)), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+class MemoryResultStore:
+    """
+        Result store that keeps the serialized results in memory.
+
+        The results are evicted in least recently used order once their total size
+        exceeds max_bytes and are dropped max_age seconds after they were stored.
+        When a spill directory is given, the results evicted for size are written
+        there instead of being dropped, until they expire.
+    """
+
+    def __init__(self, max_bytes: int, max_age: float, spill_dir: str = None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.spill = FileResultStore(spill_dir) if spill_dir else None
+
+        self.size = 0
+        self.results = OrderedDict() # job_id -> payload, least recently used first
+        self.spilled = set()
+        self.expiry = OrderedDict() # job_id -> expiry time, in insertion order
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def put(self, job_id: int, payload: bytes):
+        """
+            Store the serialized result of the given job.
+        """
+        with self.lock:
+            self.expire()
+
+            self.results[job_id] = payload
+            self.size += len(payload)
+            self.expiry[job_id] = time.monotonic() + self.max_age
+
+            while self.size > self.max_bytes and len(self.results) > 1:
+                evicted_id, evicted = self.results.popitem(last=False)
+                self.size -= len(evicted)
+
+                if self.spill is not None:
+                    self.spill.put(evicted_id, evicted)
+                    self.spilled.add(evicted_id)
+                else:
+                    del self.expiry[evicted_id]
+
+    def get(self, job_id: int):
+        """
+            Return the serialized result of the given job or None if there is none.
+        """
+        with self.lock:
+            self.expire()
+
+            payload = self.results.get(job_id)
+            if payload is not None:
+                self.results.move_to_end(job_id)
+                return payload
+
+            if job_id in self.spilled:
+                return self.spill.get(job_id)
+
+            return None
+
+    def expire(self):
+        """
+            Drop the results that are older than max_age, with the lock held.
+        """
+        now = time.monotonic()
+
+        while self.expiry:
+            job_id, expires_at = next(iter(self.expiry.items()))
+            if expires_at > now:
+                break
+
+            del self.expiry[job_id]
+            if job_id in self.results:
+                self.size -= len(self.results.pop(job_id))
+            else:
+                self.spilled.discard(job_id)
+                os.remove(os.path.join(self.spill.directory, str(job_id)))
+
+def create_result_store():
+    """
+        Create the result store selected through the RESULT_STORE environment variable:
+        "memory" (default) or "file", which keeps the results/<job_id> layout.
+    """
+    if os.getenv("RESULT_STORE", "memory") == "file":
+        return FileResultStore()
+
+    try:
+        max_bytes = int(os.getenv("RESULT_STORE_MAX_BYTES"))
+    except TypeError:
+        max_bytes = 256 * 1024 * 1024
+
+    try:
+        max_age = float(os.getenv("RESULT_STORE_TTL"))
+    except TypeError:
+        max_age = 3600.0
+
+    return MemoryResultStore(max_bytes, max_age, os.getenv("RESULT_STORE_SPILL_DIR"))
@@ -3,37 +3,146 @@
     Each task is sent to the task runner for processing. The task runner returns a job_id.
 """
 
-import json
-from flask import request, jsonify
+import os
+import time
+
+from threading import Thread
+from flask import request, jsonify, Response, g
 from app.webserver import webserver as ws
-from app.webserver import logger
+from app.webserver import logger, reload_data_ingestor
+from app.task_runner import QueueFullError, profile_key
+from app.serialization import dumps, envelope, compress, response_headers
+from app.metrics import gauge
+from app.logs.log import AsyncQueueHandler
 from . import constants as const
 
-@ws.route('/api/get_results/<job_id>', methods=['GET'])
-def get_response(job_id):
+# Upper bound for the ?wait=<seconds> long poll of /api/get_results
+MAX_WAIT_SECONDS = 30
+
+# Upper bound for the number of tasks of a single /api/batch request
+MAX_BATCH_SIZE = 1000
+
+# Default and upper bound for the number of jobs of a /api/jobs page
+JOBS_PAGE_SIZE = 1000
+MAX_JOBS_PAGE_SIZE = 10000
+
+# Answers to result polls that don't depend on the job, encoded once
+RUNNING_BODY = dumps({"status": "running"})
+INVALID_JOB_BODY = dumps({"status": "error", "reason": "Invalid job_id"})
+EXPIRED_BODY = dumps({"status": "error", "reason": "Result expired"})
+
+@ws.before_request
+def start_timer():
     """
-        This function returns the result of the task with the given job_id.
+        Record when the request started, to measure its duration.
+    """
+    g.started_at = time.monotonic()
+
+@ws.after_request
+def record_request(response):
+    """
+        Count the request and record its duration, labelled with its route
+        (the rule, not the path, so the job ids don't create new series).
     """
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    ws.requests.inc(route, request.method, str(response.status_code))
+    ws.request_duration.observe(time.monotonic() - g.started_at, route)
+    return response
 
+def parse_job_id(job_id: str):
+    """
+        Return the job_id as an int if it names a job that was created, otherwise None.
+    """
     try:
         job_id = int(job_id)
     except ValueError:
-        logger.info(f"Invalid job_id - {job_id}")
-        return jsonify({"status": "error", "reason": "Invalid job_id"})
+        return None
 
     if ws.tasks_runner.job_id <= job_id or job_id < 0:
+        return None
+    return job_id
+
+def job_result(job_id: str, parsed_job_id) -> bytes:
+    """
+        Return the serialized answer to a poll of the given job: its result once it is
+        done, the reason it failed, or its status while it is running.
+    """
+    if parsed_job_id is None:
+        logger.info(f"Invalid job_id - {job_id}")
+        return INVALID_JOB_BODY
+
+    job_id = parsed_job_id
+    job = ws.tasks_runner.jobs[job_id]
+
+    if job["status"] == "expired":
+        logger.info(f"Result expired for job_id - {job_id}")
+        return EXPIRED_BODY
+
+    if job["status"] == "error":
+        logger.info(f"Returned error for job_id - {job_id}")
+        return dumps({"status": "error", "reason": job["reason"]})
+
+    if job["status"] == "done":
+        result = ws.tasks_runner.result_store.get(job_id)
+        if result is None:
+            logger.info(f"Result expired for job_id - {job_id}")
+            return EXPIRED_BODY
+
+        # The result is already serialized, so it is placed in the response as it is
+        logger.info(f"Returned result for job_id - {job_id} (done)")
+        return envelope(result)
+
+    logger.info(f"Returned status for job_id - {job_id} (running)", extra={"sampled": True})
+    return RUNNING_BODY
+
+@ws.route('/api/get_results/<job_id>', methods=['GET'])
+def get_response(job_id):
+    """
+        This function returns the result of the task with the given job_id.
+        With ?wait=<seconds>, it waits for the task to finish before answering.
+        asgi.py serves this route itself, without blocking a thread on the wait.
+    """
+    parsed_job_id = parse_job_id(job_id)
+
+    # Long poll: block until the job finishes, for at most ?wait=<seconds>
+    wait = request.args.get("wait", type=float)
+    if parsed_job_id is not None and wait is not None and wait > 0:
+        ws.tasks_runner.wait_for_job(parsed_job_id, min(wait, MAX_WAIT_SECONDS))
+
+    body, coding = compress(job_result(job_id, parsed_job_id),
+                            request.headers.get("Accept-Encoding"))
+    return Response(body, headers=response_headers(coding))
+
+@ws.route('/api/profile/<job_id>', methods=['GET'])
+def get_profile(job_id):
+    """
+        This function returns the profile of the task with the given job_id, if it
+        was profiled (through "profile": true or TP_PROFILE_SAMPLE_RATE).
+    """
+
+    parsed_job_id = parse_job_id(job_id)
+    if parsed_job_id is None:
         logger.info(f"Invalid job_id - {job_id}")
         return jsonify({"status": "error", "reason": "Invalid job_id"})
 
-    if ws.tasks_runner.jobs[job_id]["status"] == "done":
-        with open(f"results/{job_id}", 'r', encoding='utf-8') as f:
-            result = f.read()
-            logger.info(f"Returned result for job_id - {job_id} (done)")
-            return jsonify({"status": "done", "data": json.loads(result)})
-    else:
-        logger.info(f"Returned status for job_id - {job_id} (running)")
+    job_id = parsed_job_id
+    status = ws.tasks_runner.jobs[job_id]["status"]
+
+    if status == "running":
         return jsonify({'status': 'running'})
 
+    if status == "expired":
+        logger.info(f"Result expired for job_id - {job_id}")
+        return jsonify({"status": "error", "reason": "Result expired"})
+
+    profile = ws.tasks_runner.result_store.get(profile_key(job_id))
+    if profile is None:
+        logger.info(f"No profile for job_id - {job_id}")
+        return jsonify({"status": "error", "reason": "No profile for job"})
+
+    logger.info(f"Returned profile for job_id - {job_id}")
+    return jsonify({"status": "done", "data": profile.decode("utf-8")})
+
 def generic_task(request, task):
     """
         This function is a generic function to process all the tasks.
@@ -49,7 +158,11 @@ def generic_task(request, task):
 
     data = request.json
     data["task"] = task
-    code, job_id = ws.tasks_runner.submit_task(**data)
+    try:
+        code, job_id = ws.tasks_runner.submit_task(**data)
+    except QueueFullError as e:
+        logger.info(f"Rejected task - {task}, the queue is full")
+        return overloaded(e.retry_after, {"job_id": -1})
 
     logger.info(f"Received data for task - {task} with job_id - {job_id}")
     return jsonify({
@@ -121,20 +234,89 @@ def state_mean_by_category_request():
     """
     return generic_task(request, const.STATE_MEAN_BY_CATEGORY)
 
+@ws.route('/api/batch', methods=['POST'])
+def batch_request():
+    """
+        This function is a route to submit many tasks at once. It receives a list of
+        {"task": <task name>, "question": ..., "state": ...} items and returns
+        the job_id of each of them (-1 for the items that were rejected).
+    """
+    if ws.tasks_runner.processing_on is False:
+        logger.info("Server is shutting down, can't accept new tasks")
+        return jsonify({"job_ids": [], "reason": "Server is shutting down"})
+
+    items = request.json
+    if not isinstance(items, list) or len(items) > MAX_BATCH_SIZE:
+        logger.info("Received invalid batch")
+        return jsonify({"status": "error", "reason": "Invalid batch"}), 400
+
+    task_constants = dict(const.get_task_constants())
+    errors = {}
+    tasks = []
+    positions = []
+
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or item.get("task") not in task_constants:
+            errors[index] = "Invalid task"
+            continue
+
+        tasks.append(dict(item, task=task_constants[item["task"]]))
+        positions.append(index)
+
+    job_ids = [-1] * len(items)
+    for index, (code, job_id) in zip(positions, ws.tasks_runner.submit_batch(tasks)):
+        job_ids[index] = job_id
+        if code:
+            errors[index] = code
+
+    # Nothing was accepted because the queue is full, so the client should retry later
+    if QueueFullError.MESSAGE in errors.values() and job_ids.count(-1) == len(job_ids):
+        logger.info(f"Rejected batch of {len(items)} tasks, the queue is full")
+        return overloaded(ws.tasks_runner.retry_after(), {"job_ids": job_ids, "errors": errors})
+
+    logger.info(f"Received batch of {len(items)} tasks with job_ids - {job_ids}")
+    return jsonify({
+        "message": "Received data successfully",
+        "status": "error" if errors else "success",
+        "job_ids": job_ids,
+        "errors": errors,
+    })
+
+def overloaded(retry_after, body):
+    """
+        Answer 503 with a Retry-After hint, for the requests rejected because
+        the queue is full.
+    """
+    body = dict(body, status="error", reason=QueueFullError.MESSAGE)
+    return jsonify(body), 503, {"Retry-After": str(retry_after)}
+
 @ws.route('/api/jobs', methods=['GET'])
 def jobs():
     """
-        This function returns the status of all the jobs.    
+        This function returns the status of the jobs, a page at a time:
+        ?start=<job_id>&limit=<count>&status=<running|done|error>.
+        "next" is the start of the next page, or null on the last one.
     """
+    start = request.args.get("start", 0, type=int)
+    limit = request.args.get("limit", JOBS_PAGE_SIZE, type=int)
+    status = request.args.get("status")
+
+    if start < 0 or not 0 < limit <= MAX_JOBS_PAGE_SIZE \
+            or status not in (None, "running", "done", "error"):
+        logger.info("Received invalid jobs page")
+        return jsonify({"status": "error", "reason": "Invalid page"}), 400
+
+    page, next_start = ws.tasks_runner.jobs.page(start, limit, status)
     return jsonify(
         {
             "status": "done",
             "data": [
                 {
-                    f"job_id_{job_id}": job["status"],
+                    f"job_id_{job_id}": job_status,
                 }
-                for job_id, job in ws.tasks_runner.jobs.items()
-            ]
+                for job_id, job_status in page
+            ],
+            "next": next_start,
         }
     )
 
@@ -143,10 +325,83 @@ def num_jobs():
     """
         This function returns the number of running jobs.
     """
-    return jsonify(len(list(filter(
-            lambda x: x["status"] == "running",
-            ws.tasks_runner.jobs.values()
-        ))))
+    return jsonify(ws.tasks_runner.num_running_jobs)
+
+@ws.route('/metrics', methods=['GET'])
+def metrics():
+    """
+        This function returns the metrics of the server in the Prometheus
+        text exposition format.
+    """
+    lines = (ws.tasks_runner.render_metrics() + ws.requests.render()
+             + ws.request_duration.render())
+
+    # Records lost because the log queue was full (always 0 with LOG_MODE=sync)
+    dropped = sum(handler.dropped for handler in logger.handlers
+                  if isinstance(handler, AsyncQueueHandler))
+    lines += gauge("log_records_dropped_total",
+                   "Log records dropped because the log queue was full.",
+                   {(): dropped}, metric_type="counter")
+    return Response("\n".join(lines) + "\n",
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@ws.route('/api/admin/reload', methods=['GET', 'POST'])
+def reload_dataset():
+    """
+        POST ingests a new version of the dataset in the background (the csv given as
+        {"csv_path": ...} or the current one) and swaps it in once it is ready;
+        GET returns the status of the last reload.
+    """
+    if request.method == 'GET':
+        return jsonify(dict(ws.reload_status, generation=ws.tasks_runner.dataset.generation))
+
+    csv_path = (request.get_json(silent=True) or {}).get("csv_path", ws.csv_path)
+    if not isinstance(csv_path, str):
+        logger.info("Received reload with an invalid csv_path")
+        return jsonify({"status": "error", "reason": "Invalid csv_path"}), 400
+
+    return start_reload(csv_path, False)
+
+@ws.route('/api/admin/append', methods=['POST'])
+def append_dataset():
+    """
+        Appends the rows of the delta csv given as {"csv_path": ...} to the dataset,
+        in the background, updating the aggregates instead of rebuilding them.
+    """
+    csv_path = (request.get_json(silent=True) or {}).get("csv_path")
+    if not isinstance(csv_path, str):
+        logger.info("Received append without csv_path")
+        return jsonify({"status": "error", "reason": "csv_path not provided"}), 400
+
+    return start_reload(csv_path, True)
+
+def in_data_dir(csv_path: str) -> bool:
+    """
+        Check if the csv is inside the data directory (DATA_DIR), once symbolic
+        links and ".." are resolved.
+    """
+    path = os.path.realpath(csv_path)
+    return os.path.commonpath([path, ws.data_dir]) == ws.data_dir
+
+def start_reload(csv_path, append):
+    """
+        Start reloading (or appending to) the dataset on a background thread, unless
+        the csv is outside the data directory or another reload is in progress.
+    """
+    if not in_data_dir(csv_path):
+        logger.info(f"Received csv_path outside the data directory - {csv_path}")
+        return jsonify({"status": "error", "reason": "csv_path outside the data directory"}), 400
+
+    if not ws.reload_lock.acquire(blocking=False):
+        logger.info("Reload already in progress")
+        return jsonify({"status": "error", "reason": "Reload already in progress"}), 409
+
+    reload_status = {"status": "appending" if append else "reloading", "csv_path": csv_path}
+    ws.reload_status = reload_status
+    Thread(target=reload_data_ingestor, args=(csv_path, append), daemon=True).start()
+
+    logger.info(f"{'Appending to' if append else 'Reloading'} the dataset from {csv_path}")
+    return jsonify(reload_status)
 
 @ws.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown():
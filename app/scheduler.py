@@ -0,0 +1,187 @@
+"""
+    Scheduler of the task queue: one lane per task type, dequeued in weighted fair
+    order, and an optional priority that lets urgent entries overtake the others.
+"""
+
+import heapq
+import itertools
+import os
+
+from threading import Condition
+from . import constants as const
+
+# Share of the workers each lane gets when all of them are backlogged. The tasks
+# that return a single value get a larger share than the ones that return a
+# value per state or per category, so a burst of the latter can't starve them.
+DEFAULT_LANE_WEIGHTS = {
+    "state_mean": 4,
+    "state_diff_from_mean": 4,
+    "global_mean": 4,
+    "best5": 4,
+    "worst5": 4,
+    "state_mean_by_category": 2,
+    "states_mean": 2,
+    "diff_from_mean": 2,
+    "mean_by_category": 1,
+    "batch": 1,
+}
+
+class Lane:
+    """
+        Entries of one lane, ordered by priority (highest first) and then FIFO.
+    """
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.entries = [] # heap of (-priority, sequence, entry)
+        self.priorities = {} # priority -> number of entries
+
+        # Virtual time of the lane: grows by 1 / weight with every dequeued entry
+        self.pass_value = 0.0
+
+class TaskScheduler:
+    """
+        Drop-in replacement of the FIFO task queue of the ThreadPool.
+
+        get() first looks at the highest priority waiting in any lane and, among the
+        lanes holding an entry of that priority, picks the one with the lowest virtual
+        time (stride scheduling), so backlogged lanes are served in proportion to
+        their weights. A lane that was idle starts from the current virtual time
+        instead of catching up on the turns it didn't use.
+    """
+
+    def __init__(self, weights: dict):
+        self.weights = weights
+        self.lanes = {}
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        self.size = 0
+        self.priorities = {} # priority -> number of entries, over all the lanes
+        self.closed = False
+        self.condition = Condition()
+
+    def lane(self, name: str) -> Lane:
+        """
+            Return the lane with the given name, creating it on first use.
+        """
+        lane = self.lanes.get(name)
+        if lane is None:
+            lane = Lane(name, self.weights.get(name, 1))
+            self.lanes[name] = lane
+        return lane
+
+    def put(self, entry, lane: str, priority: int = 0):
+        """
+            Queue an entry in the given lane.
+        """
+        with self.condition:
+            current = self.lane(lane)
+            if not current.entries:
+                current.pass_value = max(current.pass_value, self.virtual_time)
+
+            heapq.heappush(current.entries, (-priority, next(self.sequence), entry))
+            self.count(current, priority, 1)
+            self.size += 1
+            self.condition.notify()
+
+    def get(self):
+        """
+            Block until an entry is available and return it. Once the scheduler is
+            closed and empty, return GRACEFUL_SHUTDOWN instead.
+        """
+        with self.condition:
+            while not self.size:
+                if self.closed:
+                    return const.GRACEFUL_SHUTDOWN
+                self.condition.wait()
+
+            lane = min(
+                (lane for lane in self.lanes.values() if lane.entries),
+                key=lambda lane: (lane.entries[0][0], lane.pass_value)
+            )
+
+            negated_priority, _, entry = heapq.heappop(lane.entries)
+            self.count(lane, -negated_priority, -1)
+            self.virtual_time = lane.pass_value
+            lane.pass_value += 1 / lane.weight
+            self.size -= 1
+            return entry
+
+    def shed(self, priority: int):
+        """
+            Remove and return the most recently queued entry among those of the lowest
+            priority, if it is lower than the given one, or None.
+
+            The lowest queued priority is known from the counts, so a request that
+            can't shed anything (e.g. when every entry has the default priority) is
+            turned away without looking at the entries.
+        """
+        with self.condition:
+            if not self.priorities:
+                return None
+
+            lowest = min(self.priorities)
+            if lowest >= priority:
+                return None
+
+            # Only the lanes holding an entry of the lowest priority are searched
+            _, lane, index = max(
+                ((item[1], lane, index)
+                 for lane in self.lanes.values() if lowest in lane.priorities
+                 for index, item in enumerate(lane.entries) if item[0] == -lowest),
+                key=lambda x: x[0]
+            )
+
+            _, _, entry = lane.entries.pop(index)
+            heapq.heapify(lane.entries)
+            self.count(lane, lowest, -1)
+            self.size -= 1
+            return entry
+
+    def count(self, lane: Lane, priority: int, delta: int):
+        """
+            Update the number of entries of the given priority, with the lock held.
+        """
+        for priorities in (lane.priorities, self.priorities):
+            priorities[priority] = priorities.get(priority, 0) + delta
+            if not priorities[priority]:
+                del priorities[priority]
+
+    def close(self):
+        """
+            Stop blocking: the workers drain the remaining entries and then get
+            GRACEFUL_SHUTDOWN.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def qsize(self) -> int:
+        """
+            Return the number of queued entries.
+        """
+        return self.size
+
+    def depths(self) -> dict:
+        """
+            Return the number of queued entries of every lane.
+        """
+        with self.condition:
+            return {name: len(lane.entries) for name, lane in self.lanes.items()}
+
+def create_scheduler() -> TaskScheduler:
+    """
+        Create the task scheduler, with the lane weights overridden through
+        TP_LANE_WEIGHTS, e.g. "mean_by_category=1,state_mean=8".
+    """
+    weights = dict(DEFAULT_LANE_WEIGHTS)
+
+    for item in filter(None, os.getenv("TP_LANE_WEIGHTS", "").split(",")):
+        name, _, weight = item.partition("=")
+        name, weight = name.strip(), float(weight)
+        if not weight > 0:
+            raise ValueError(f"Invalid weight for lane {name}")
+        weights[name] = weight
+
+    return TaskScheduler(weights)
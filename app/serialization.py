@@ -0,0 +1,103 @@
+"""
+    Serialization of the results and of the responses that carry them.
+
+    Every result is encoded once, by the worker that computed it, with orjson when it
+    is installed (and the json module otherwise). The stored bytes are then placed in
+    the response envelope as they are, and compressed for the clients that accept it.
+"""
+
+import json
+import math
+import os
+import zlib
+
+try:
+    import orjson
+except ImportError: # optional, the json module is used instead
+    orjson = None
+
+# Responses smaller than this are sent uncompressed, as compression wouldn't pay off
+try:
+    COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES"))
+except TypeError:
+    COMPRESS_MIN_BYTES = 1024
+
+# zlib window bits of each supported content coding
+ENCODINGS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+def dumps(value) -> bytes:
+    """
+        Serialize a value to compact JSON bytes. NaN and infinities, which JSON has no
+        notation for (e.g. the global mean of a question without rows), become null.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    try:
+        return json.dumps(value, separators=(",", ":"), allow_nan=False).encode("utf-8")
+    except ValueError:
+        return json.dumps(finite(value), separators=(",", ":")).encode("utf-8")
+
+def finite(value):
+    """
+        Return the value with its NaN and infinite floats replaced by None, the way
+        orjson writes them.
+    """
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite(item) for item in value]
+    return value
+
+def envelope(payload: bytes) -> bytes:
+    """
+        Wrap a serialized result in the body of a done job, without parsing it.
+    """
+    return b'{"status":"done","data":' + payload + b'}'
+
+def accepted_encoding(accept_encoding: str):
+    """
+        Return the content coding to answer with, given the Accept-Encoding header of
+        the request: gzip or deflate, in this order of preference, or None.
+    """
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+
+    if "*" in accepted:
+        return "gzip"
+    return next((coding for coding in ENCODINGS if coding in accepted), None)
+
+def compress(payload: bytes, accept_encoding: str) -> tuple:
+    """
+        Compress a response body if it is large enough and the client accepts one of
+        the supported codings. Return the body and its coding (None if uncompressed).
+    """
+    if len(payload) < COMPRESS_MIN_BYTES:
+        return payload, None
+
+    coding = accepted_encoding(accept_encoding)
+    if coding is None:
+        return payload, None
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, ENCODINGS[coding])
+    return compressor.compress(payload) + compressor.flush(), coding
+
+def response_headers(coding) -> dict:
+    """
+        Return the headers of a JSON response with the given content coding.
+    """
+    headers = {"Content-Type": "application/json", "Vary": "Accept-Encoding"}
+    if coding is not None:
+        headers["Content-Encoding"] = coding
+    return headers
@@ -0,0 +1,141 @@
+"""
+    Binary snapshots of the ingested dataset, so a restart loads the columns
+    directly instead of parsing the csv again.
+
+    A snapshot is a directory of .npy files, one per array. The columns are
+    memory-mapped read-only when loaded, so every server process on a host
+    shares the same physical pages instead of holding its own copy.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+
+# Bumped whenever the layout of the snapshot changes
+SNAPSHOT_VERSION = 2
+
+COLUMNS = ("values", "year_start", "year_end", "question",
+           "state", "category", "category_value")
+DICTIONARIES = ("questions", "states", "categories", "category_values")
+
+def csv_signature(csv_path: str) -> np.ndarray:
+    """
+        Identify the version of the csv a snapshot was built from, by its size and mtime.
+    """
+    stat = os.stat(csv_path)
+    return np.array([SNAPSHOT_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def snapshot_path(csv_path: str, snapshot_dir: str) -> str:
+    """
+        Return the path of the snapshot directory of the given csv. It is named after
+        the absolute path of the csv, so csvs with the same name in different
+        directories don't replace each other's snapshot.
+    """
+    digest = hashlib.sha256(os.path.abspath(csv_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(snapshot_dir, f"{os.path.basename(csv_path)}.{digest}.snapshot")
+
+@contextmanager
+def snapshot_lock(csv_path: str, snapshot_dir: str):
+    """
+        Hold an exclusive lock on the snapshot of the csv, so that when several server
+        processes start together only one of them parses the csv and writes the snapshot.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    if fcntl is None:
+        yield
+        return
+
+    with open(snapshot_path(csv_path, snapshot_dir) + ".lock", "w", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def save_snapshot(data_ingestor, csv_path: str, snapshot_dir: str):
+    """
+        Write the columns, dictionaries and offsets of the data ingestor to its snapshot.
+        The directory is written under a temporary name and then renamed, so a
+        concurrent reader never sees a partial snapshot.
+    """
+    arrays = {name: getattr(data_ingestor, name) for name in COLUMNS}
+    arrays.update({
+        name: np.array(getattr(data_ingestor, name).values, dtype=str)
+        for name in DICTIONARIES
+    })
+
+    # state_offsets is flattened into (question, state, start, stop) rows
+    arrays["question_offsets"] = data_ingestor.question_offsets
+    arrays["state_offsets"] = np.array([
+        (question, state, start, stop)
+        for question, states in enumerate(data_ingestor.state_offsets)
+        for state, (start, stop) in states.items()
+    ], dtype=np.int64).reshape(-1, 4)
+    arrays["signature"] = csv_signature(csv_path)
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=snapshot_dir, suffix=".tmp")
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+        os.chmod(tmp_path, 0o755)
+
+        # A stale snapshot is moved out of the way first: processes that still map
+        # its files keep them until they unmap them
+        path = snapshot_path(csv_path, snapshot_dir)
+        if os.path.exists(path):
+            stale_path = tempfile.mkdtemp(dir=snapshot_dir, suffix=".stale")
+            os.replace(path, os.path.join(stale_path, "snapshot"))
+            shutil.rmtree(stale_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+def load_snapshot(data_ingestor, csv_path: str, snapshot_dir: str) -> bool:
+    """
+        Fill the data ingestor from the snapshot of the csv, memory-mapping its columns.
+        Return False, leaving the data ingestor untouched, if there is no up-to-date
+        snapshot.
+    """
+    path = snapshot_path(csv_path, snapshot_dir)
+
+    try:
+        if not np.array_equal(np.load(os.path.join(path, "signature.npy")),
+                              csv_signature(csv_path)):
+            return False
+
+        arrays = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            for name in COLUMNS
+        }
+        arrays.update({
+            name: np.load(os.path.join(path, name + ".npy"))
+            for name in DICTIONARIES + ("question_offsets", "state_offsets")
+        })
+    except (OSError, ValueError, EOFError):
+        return False
+
+    for name in DICTIONARIES:
+        setattr(data_ingestor, name, type(getattr(data_ingestor, name))(arrays[name].tolist()))
+
+    for name in COLUMNS:
+        setattr(data_ingestor, name, arrays[name])
+
+    data_ingestor.question_offsets = arrays["question_offsets"]
+    data_ingestor.state_offsets = [{} for _ in range(len(data_ingestor.questions))]
+    for question, state, start, stop in arrays["state_offsets"].tolist():
+        data_ingestor.state_offsets[question][state] = (start, stop)
+
+    return True
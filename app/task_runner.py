@@ -1,14 +1,166 @@
 """ Worker thread pool to process tasks. """
 
-import json
+import cProfile
+import io
+import math
+import multiprocessing
 import os
+import pstats
+import random
+import time
 
-from threading import Thread, Condition
-from queue import Queue
+from threading import Thread, Condition, Event, Lock
 from .data_ingestor import DataIngestor
+from .result_store import create_result_store
+from .result_cache import create_result_cache
+from .job_registry import create_job_registry
+from .metrics import Counter, Histogram, gauge
+from .scheduler import create_scheduler
+from .serialization import dumps
 from . import constants as const
 from .tasks import *
 
+# State of a worker process of the process backend, inherited from the server at fork
+WORKER_DATA_INGESTOR = None
+WORKER_TASK_MAPPER = {}
+
+def get_task_mapper():
+    """
+        Map the task constant to the function that processes the task.
+    """
+    return {task: globals()[name] for name, task in const.get_task_constants()}
+
+def init_worker(data_ingestor: DataIngestor):
+    """
+        Initialize a worker process of the process backend.
+    """
+    global WORKER_DATA_INGESTOR # pylint: disable=global-statement
+    WORKER_DATA_INGESTOR = data_ingestor
+    WORKER_TASK_MAPPER.update(get_task_mapper())
+
+# Number of functions listed in the profile of a job
+PROFILE_LINES = 40
+
+# Held while a task of this process is profiled
+PROFILE_LOCK = Lock()
+
+def execute_tasks(task_mapper: dict, data_ingestor: DataIngestor, tasks: list) -> list:
+    """
+        Execute the tasks one after the other and return a (result, error, profile)
+        triple for each, so a failing task doesn't prevent the others from running.
+        The profile is None unless the task asked to be profiled.
+    """
+    outcomes = []
+    for task in tasks:
+        if task.get("profile"):
+            outcomes.append(profile_task(task_mapper, data_ingestor, task))
+            continue
+
+        try:
+            outcomes.append((task_mapper[task["task"]](data_ingestor, task), None, None))
+        except Exception as e: # pylint: disable=broad-exception-caught
+            outcomes.append((None, e, None))
+    return outcomes
+
+def profile_task(task_mapper: dict, data_ingestor: DataIngestor, task: dict) -> tuple:
+    """
+        Execute the task under cProfile and return its (result, error, profile) triple,
+        the profile being the report of the functions with the most cumulative time.
+
+        Only one profiler can be active in a process since Python 3.12, so the
+        profiled tasks of a process run one at a time. If another profiling tool is
+        active anyway, the task runs unprofiled rather than failing. Python 3.12+ also
+        profiles every thread, so the report may include other tasks running meanwhile.
+    """
+    profiler = cProfile.Profile()
+    result, error = None, None
+
+    with PROFILE_LOCK:
+        try:
+            profiler.enable()
+        except ValueError as e:
+            result, error, _ = execute_tasks(task_mapper, data_ingestor,
+                                             [dict(task, profile=False)])[0]
+            return result, error, f"Not profiled: {e}\n"
+
+        try:
+            result = task_mapper[task["task"]](data_ingestor, task)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            error = e
+        finally:
+            profiler.disable()
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    return result, error, report.getvalue()
+
+def run_in_worker(tasks: list) -> list:
+    """
+        Run tasks inside a worker process of the process backend.
+    """
+    return execute_tasks(WORKER_TASK_MAPPER, WORKER_DATA_INGESTOR, tasks)
+
+def create_process_pool(data_ingestor: DataIngestor, num_processes: int):
+    """
+        Start the worker processes of the process backend.
+
+        The aggregates are built before forking, so the workers share them and
+        the dataset copy-on-write instead of receiving a pickled copy.
+    """
+    data_ingestor.build_aggregates()
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+
+    return context.Pool(num_processes, initializer=init_worker, initargs=(data_ingestor,))
+
+def profile_key(job_id: int) -> str:
+    """
+        Return the key under which the profile of a job is kept in the result store.
+    """
+    return f"{job_id}.profile"
+
+# Upper bound for the retry-after hint returned when the queue is full
+MAX_RETRY_AFTER = 60
+
+class QueueFullError(Exception):
+    """
+        Raised when a task can't be queued because the queue is full and
+        there is no queued task of lower priority to shed in its place.
+    """
+    MESSAGE = "Server overloaded"
+
+    def __init__(self, retry_after: int):
+        super().__init__(self.MESSAGE)
+        self.retry_after = retry_after
+
+class Dataset:
+    """
+        A version of the data the tasks run against: the data ingestor and, with the
+        process backend, the worker processes forked for it. Every reload creates a
+        new one, and the previous one is closed once its last queued task is done.
+    """
+    def __init__(self, generation: int, data_ingestor: DataIngestor, num_processes: int):
+        self.generation = generation
+        self.data_ingestor = data_ingestor
+
+        # Queued or running tasks of this version, guarded by the pool's job_condition
+        self.pending = 0
+
+        self.process_pool = None
+        if num_processes:
+            self.process_pool = create_process_pool(data_ingestor, num_processes)
+
+    def close(self):
+        """
+            Stop the worker processes of this version, if any.
+        """
+        if self.process_pool is not None:
+            self.process_pool.close()
+            self.process_pool.join()
+
 class ThreadPool:
     """
         Worker thread pool (load balancer) to process tasks.
@@ -19,13 +171,54 @@ class ThreadPool:
         except TypeError:
             self.num_threads = os.cpu_count()
 
-        self.job_id = 0
-        self.jobs = {}
+        self.jobs = create_job_registry()
         self.job_condition = Condition()
-        self.data_ingestor = data_ingestor
 
-        self.tasks = Queue()
-        self.threads = [TaskRunner(self, data_ingestor) for _ in range(self.num_threads)]
+        # Key of every queued or running task -> ids of the jobs that wait for it
+        self.in_flight = {}
+
+        # job_id -> callbacks to call when the job finishes, for the clients waiting on it
+        self.job_waiters = {}
+        self.result_store = create_result_store()
+        self.result_cache = create_result_cache()
+
+        # "thread" runs the tasks inside the TaskRunner threads, "process" hands them
+        # over to a pool of worker processes to get around the GIL
+        self.backend = os.getenv("TP_BACKEND", "thread")
+        self.dataset = Dataset(0, data_ingestor, self.num_processes())
+
+        # Per task type durations, labelled with the name of the task
+        self.task_names = {task: name for name, task in const.get_task_constants()}
+        self.queue_wait = Histogram("task_queue_wait_seconds",
+                                    "Time tasks spend queued before a worker picks them up.",
+                                    ("task",))
+        self.execution_time = Histogram("task_execution_seconds",
+                                        "Time spent computing tasks.", ("task",))
+        self.completed = Counter("tasks_completed_total",
+                                 "Tasks computed, by task and outcome.", ("task", "outcome"))
+        self.rejected = Counter("tasks_rejected_total",
+                                "Tasks turned away because the queue was full, by task and "
+                                "reason (rejected on submission or shed for a more urgent one).",
+                                ("task", "reason"))
+
+        # Share of the tasks profiled without asking for it (see TaskRunner.write_profile)
+        try:
+            self.profile_rate = float(os.getenv("TP_PROFILE_SAMPLE_RATE"))
+        except TypeError:
+            self.profile_rate = 0.0
+
+        # Tasks queued and not yet picked up by a worker, bounded by max_queued (0 for
+        # no bound) so an overload can't grow the backlog until memory runs out
+        try:
+            self.max_queued = int(os.getenv("TP_MAX_QUEUE_DEPTH"))
+        except TypeError:
+            self.max_queued = 10000
+        self.queued = 0
+
+        # Queue entries are (dataset, tasks, time they were queued at), scheduled
+        # in one lane per task type (see scheduler.py)
+        self.tasks = create_scheduler()
+        self.threads = [TaskRunner(self) for _ in range(self.num_threads)]
 
         self.processing_on = True # Flag to indicate if the thread pool is processing tasks
 
@@ -35,17 +228,75 @@ class ThreadPool:
         """
         self.processing_on = False
 
-        # Send a signal to all threads to shutdown
-        for _ in range(self.num_threads):
-            self.tasks.put(const.GRACEFUL_SHUTDOWN)
+        # Signal all threads to shutdown once the queued tasks are done
+        self.tasks.close()
 
         for thread in self.threads:
             thread.join()
 
+        self.dataset.close()
+
+    @property
+    def job_id(self) -> int:
+        """
+            The job_id the next job gets.
+        """
+        return self.jobs.next_id
+
+    @property
+    def num_running_jobs(self) -> int:
+        """
+            The number of running jobs, counted as the jobs change status.
+        """
+        return self.jobs.running
+
+    @property
+    def data_ingestor(self) -> DataIngestor:
+        """
+            The data ingestor new tasks run against.
+        """
+        return self.dataset.data_ingestor
+
+    def num_processes(self) -> int:
+        """
+            Return the number of worker processes of the backend (0 for threads).
+        """
+        return self.num_threads if self.backend == "process" else 0
+
+    def reload(self, data_ingestor: DataIngestor):
+        """
+            Swap in a new version of the data. The tasks queued before the swap still
+            run against the previous version, the ones submitted after it against the
+            new one, and the results cached for the previous version are dropped.
+        """
+        data_ingestor.build_aggregates()
+        dataset = Dataset(self.dataset.generation + 1, data_ingestor, self.num_processes())
+
+        with self.job_condition:
+            previous, self.dataset = self.dataset, dataset
+            retired = previous.pending == 0
+
+        self.result_cache.invalidate()
+        if retired:
+            previous.close()
+
+    def release_dataset(self, dataset: Dataset, count: int):
+        """
+            Account for count finished tasks of the given version of the data,
+            closing it if it was replaced and has no more tasks.
+        """
+        with self.job_condition:
+            dataset.pending -= count
+            retired = dataset.pending == 0 and dataset is not self.dataset
+
+        if retired:
+            dataset.close()
+
     """
         Return:
             0, job_id: if the task was successfully submitted
             error_message, -1: if the task was not successfully submitted
+        Raise QueueFullError if the queue is full.
     """
     def submit_task(self, **kwargs):
         """
@@ -56,61 +307,325 @@ class ThreadPool:
         except ValueError as e:
             return str(e), -1
 
+        self.sample_profile(kwargs)
+        current_job_id, dataset = self.register_job(kwargs)
+
+        # Put the task in the lane of its type
+        if dataset is not None:
+            self.tasks.put((dataset, [kwargs], time.monotonic()),
+                           self.task_names[kwargs["task"]], kwargs.get("priority", 0))
+        return 0, current_job_id
+
+    def submit_batch(self, tasks: list) -> list:
+        """
+            Submit many tasks at once, returning a (code, job_id) pair for each of them
+            like submit_task. The tasks about the same question are queued together,
+            so a single worker answers all of them, in the batch lane and with the
+            highest priority among them.
+        """
+        submitted = []
+        groups = {}
+
+        for task in tasks:
+            try:
+                self.validate_task(**task)
+            except ValueError as e:
+                submitted.append((str(e), -1))
+                continue
+
+            self.sample_profile(task)
+            try:
+                current_job_id, dataset = self.register_job(task)
+            except QueueFullError as e:
+                submitted.append((str(e), -1))
+                continue
+
+            if dataset is not None:
+                groups.setdefault((dataset, task["question"]), []).append(task)
+            submitted.append((0, current_job_id))
+
+        for (dataset, _), group in groups.items():
+            lane = self.task_names[group[0]["task"]] if len(group) == 1 else "batch"
+            priority = max(task.get("priority", 0) for task in group)
+            self.tasks.put((dataset, group, time.monotonic()), lane, priority)
+        return submitted
+
+    def sample_profile(self, task: dict):
+        """
+            Mark a share of profile_rate of the tasks to be profiled.
+        """
+        if self.profile_rate and random.random() < self.profile_rate:
+            task["profile"] = True
+
+    def register_job(self, task: dict) -> tuple:
+        """
+            Assign a job_id to the task and return it, along with the version of the
+            data the task must be queued for, or None if there is no need to queue it
+            (an identical task is in flight or cached).
+            Raise QueueFullError, without creating a job, if the queue is full.
+        """
         # Assign a job_id to the task,
         # using a lock to ensure safety in assigning job_id
         with self.job_condition:
-            current_job_id = self.job_id
-            self.job_id += 1
+            dataset = self.dataset
+            key = self.task_key(task, dataset.generation)
 
-        self.jobs[current_job_id] = {
-            "status": "running",
-        }
+            # An identical task is being computed, so the job shares its result
+            if key in self.in_flight:
+                current_job_id = self.jobs.create()
+                self.in_flight[key].append(current_job_id)
+                return current_job_id, None
 
-        # Put the task in the queue (blocking operation)
-        self.tasks.put((current_job_id, kwargs))
-        return 0, current_job_id
+            # An identical task was computed before, so its result is reused,
+            # unless the task must be profiled
+            payload = None if task.get("profile") else self.result_cache.get(key)
+            if payload is not None:
+                current_job_id = self.jobs.create()
+                self.result_store.put(current_job_id, payload)
+                self.jobs[current_job_id] = {"status": "done"}
+                return current_job_id, None
+
+            if 0 < self.max_queued <= self.queued:
+                self.shed_for(task)
+
+            current_job_id = self.jobs.create()
+            self.in_flight[key] = [current_job_id]
+            dataset.pending += 1
+            self.queued += 1
+
+        return current_job_id, dataset
+
+    def shed_for(self, task: dict):
+        """
+            Make room in the full queue for the task, with job_condition held, by
+            dropping the most recent of the queued entries of the lowest priority,
+            if it is lower than the priority of the task. The jobs of the dropped
+            entry fail; if there is nothing to drop, raise QueueFullError.
+        """
+        entry = self.tasks.shed(task.get("priority", 0))
+        if entry is None:
+            self.rejected.inc(self.task_names[task["task"]], "queue_full")
+            raise QueueFullError(self.retry_after())
+
+        dataset, tasks, _ = entry
+        self.queued -= len(tasks)
+
+        for shed_task in tasks:
+            self.rejected.inc(self.task_names[shed_task["task"]], "shed")
+            self.finish_jobs(self.complete_task(self.task_key(shed_task, dataset.generation)), {
+                "status": "error",
+                "reason": "Task shed under load",
+            })
+
+        self.release_dataset(dataset, len(tasks))
+
+    def retry_after(self) -> int:
+        """
+            Estimate in how many seconds the queue has room again: the time the workers
+            take to drain the queued tasks at their mean execution time so far.
+        """
+        total, count = self.execution_time.totals()
+        mean_time = total / count if count else 0
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(self.queued * mean_time / self.num_threads)))
+
+    def dequeued(self, count: int):
+        """
+            Account for count tasks picked up by a worker, freeing their room in the queue.
+        """
+        with self.job_condition:
+            self.queued -= count
+
+    def complete_task(self, key: tuple) -> list:
+        """
+            Return the ids of the jobs waiting for the task with the given key,
+            which stops accepting new jobs.
+        """
+        with self.job_condition:
+            return self.in_flight.pop(key)
+
+    def finish_jobs(self, job_ids: list, job: dict):
+        """
+            Set the final state of the given jobs and wake up the clients waiting on them.
+        """
+        with self.job_condition:
+            for job_id in job_ids:
+                self.jobs[job_id] = job
+
+                for callback in self.job_waiters.pop(job_id, ()):
+                    callback()
+
+    def add_job_waiter(self, job_id: int, callback) -> bool:
+        """
+            Register a callback to be called, from the thread that finishes the job,
+            once the job is no longer running. Return False, without registering it,
+            if the job already finished.
+        """
+        with self.job_condition:
+            if self.jobs[job_id]["status"] != "running":
+                return False
+
+            self.job_waiters.setdefault(job_id, []).append(callback)
+            return True
+
+    def remove_job_waiter(self, job_id: int, callback):
+        """
+            Unregister a callback of a job that gave up waiting.
+        """
+        with self.job_condition:
+            callbacks = self.job_waiters.get(job_id, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.job_waiters.pop(job_id, None)
+
+    def wait_for_job(self, job_id: int, timeout: float):
+        """
+            Block until the job is no longer running or the timeout (in seconds) expires.
+        """
+        event = Event()
+        if self.add_job_waiter(job_id, event.set) and not event.wait(timeout):
+            self.remove_job_waiter(job_id, event.set)
+
+    def task_key(self, task: dict, generation: int) -> tuple:
+        """
+            Return the key under which the result of the task is cached, keeping only
+            the fields of the request that the task depends on, the version of the
+            data it runs against and whether it is profiled.
+        """
+        state = task.get("state") if task["task"] in const.STATE_TASKS else None
+        return generation, task["task"], task["question"], state, bool(task.get("profile"))
+
+    def render_metrics(self) -> list:
+        """
+            Return the metrics of the pool in the Prometheus text exposition format:
+            the histograms and counters recorded by the workers, and the gauges of the
+            queue, the workers, the result store and the result cache read right now.
+        """
+        busy = sum(thread.busy for thread in self.threads)
+        store = self.result_store
+        cache = self.result_cache
+        lookups = cache.hits + cache.misses
+
+        lines = gauge("task_queue_depth", "Entries waiting in the task queue, by lane.",
+                      {(lane,): depth for lane, depth in self.tasks.depths().items()}, ("lane",))
+        lines += gauge("task_queue_limit", "Maximum number of queued tasks (0 for no limit).",
+                       {(): self.max_queued})
+        lines += gauge("task_runners", "Worker threads, by state.",
+                       {("busy",): busy, ("idle",): len(self.threads) - busy}, ("state",))
+        lines += gauge("jobs_submitted_total", "Jobs submitted since the server started.",
+                       {(): self.job_id}, metric_type="counter")
+        lines += gauge("jobs_running", "Jobs not finished yet.", {(): self.num_running_jobs})
+        lines += gauge("jobs_retained", "Jobs kept in the job registry.", {(): len(self.jobs)})
+        lines += gauge("dataset_generation", "Version of the data served.",
+                       {(): self.dataset.generation})
+
+        if hasattr(store, "size"):
+            lines += gauge("result_store_entries", "Results held in memory.",
+                           {(): len(store)})
+            lines += gauge("result_store_bytes", "Size of the results held in memory.",
+                           {(): store.size})
+
+        lines += gauge("result_cache_entries", "Results in the result cache.",
+                       {(): len(cache)})
+        lines += gauge("result_cache_hits_total", "Lookups answered by the result cache.",
+                       {(): cache.hits}, metric_type="counter")
+        lines += gauge("result_cache_misses_total", "Lookups missed by the result cache.",
+                       {(): cache.misses}, metric_type="counter")
+        lines += gauge("result_cache_hit_ratio", "Share of the lookups that were hits.",
+                       {(): cache.hits / lookups if lookups else 0})
+
+        return (lines + self.queue_wait.render() + self.execution_time.render()
+                + self.completed.render() + self.rejected.render())
 
     def validate_task(self, **kwargs):
         """
-            Validate the task, checking if it contains 'question' key.
+            Validate the task, checking if it contains 'question' key
+            and, if given, an integer 'priority' and a boolean 'profile'.
         """
         if "question" not in kwargs:
             raise ValueError("Question not provided")
 
-        if kwargs["question"] not in self.data_ingestor.data.keys():
+        priority = kwargs.get("priority", 0)
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise ValueError("Invalid priority")
+
+        if not isinstance(kwargs.get("profile", False), bool):
+            raise ValueError("Invalid profile flag")
+
+        if not self.data_ingestor.has_question(kwargs["question"]):
             raise ValueError("Invalid question")
 
 class TaskRunner(Thread):
     """
         Worker thread to process tasks.
     """
-    def __init__(self, pool: ThreadPool, data_ingestor: DataIngestor):
+    def __init__(self, pool: ThreadPool):
         super().__init__()
         self.pool = pool
-        self.data_ingestor = data_ingestor
         self.processing_on = True
+        self.busy = False
 
         self.set_task_mapper()
         self.start()
 
-    def write_result(self, job_id, result):
+    def write_result(self, dataset, task, result, profile=None):
         """
-            Write the result to a file.
+            Serialize the result, cache it and write it to the result store
+            for every job that waits for the task.
         """
-        with open(f"results/{job_id}", "w", encoding="utf-8") as f:
-            f.write(json.dumps(result))
+        payload = dumps(result)
+        key = self.pool.task_key(task, dataset.generation)
+        if profile is None:
+            self.pool.result_cache.put(key, payload)
 
-        self.pool.jobs[job_id]["status"] = "done"
+        job_ids = self.pool.complete_task(key)
+        for job_id in job_ids:
+            self.pool.result_store.put(job_id, payload)
+        self.write_profile(job_ids, profile)
+
+        self.pool.finish_jobs(job_ids, {"status": "done"})
+
+    def write_error(self, dataset, task, error, profile=None):
+        """
+            Mark every job that waits for the failed task as failed.
+        """
+        reason = str(error) if isinstance(error, ValueError) else f"Task failed: {error!r}"
+        key = self.pool.task_key(task, dataset.generation)
+
+        job_ids = self.pool.complete_task(key)
+        self.write_profile(job_ids, profile)
+
+        self.pool.finish_jobs(job_ids, {
+            "status": "error",
+            "reason": reason,
+        })
+
+    def write_profile(self, job_ids: list, profile: str):
+        """
+            Store the profile of a profiled task beside the result of its jobs.
+        """
+        if profile is None:
+            return
+
+        payload = profile.encode("utf-8")
+        for job_id in job_ids:
+            self.pool.result_store.put(profile_key(job_id), payload)
 
     def set_task_mapper(self):
         """
             Map the task name to the function that processes the task.
         """
-        self.task_mapper = {}
-        constants = const.get_task_constants()
+        self.task_mapper = get_task_mapper()
 
-        for _, task in enumerate(constants):
-            self.task_mapper[task[1]] = globals()[task[0]]
+    def execute_tasks(self, dataset: Dataset, tasks: list) -> list:
+        """
+            Execute the tasks against the given version of the data, on the backend
+            of the pool, and return their (result, error, profile) triples.
+        """
+        if dataset.process_pool is not None:
+            return dataset.process_pool.apply(run_in_worker, (tasks,))
+
+        return execute_tasks(self.task_mapper, dataset.data_ingestor, tasks)
 
     def graceful_shutdown(self):
         """
@@ -123,16 +638,45 @@ class TaskRunner(Thread):
             This function is the main function for the TaskRunner thread.
         """
         while self.processing_on:
-            # Get a task from the queue using block flag to wait until
-            # a task is available and avoid busy waiting
-            task = self.pool.tasks.get(block=True)
+            # Get a task from the scheduler, which blocks until
+            # a task is available to avoid busy waiting
+            task = self.pool.tasks.get()
 
             if task == const.GRACEFUL_SHUTDOWN:
                 self.graceful_shutdown()
                 continue
 
-            # Execute task
-            data = self.task_mapper[task[1]["task"]](self.data_ingestor, task[1])
+            self.busy = True
+            self.process(*task)
+            self.busy = False
+
+    def process(self, dataset: Dataset, tasks: list, queued_at: float):
+        """
+            Execute the tasks of a queue entry and write their results.
+        """
+        started_at = time.monotonic()
+        self.pool.dequeued(len(tasks))
+
+        # Execute the tasks (one, or a group about the same question), making sure
+        # the jobs that wait for them are released even if the backend fails
+        try:
+            outcomes = self.execute_tasks(dataset, tasks)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            outcomes = [(None, e, None)] * len(tasks)
+
+        # A group is executed in one go, so its time is split evenly between its tasks
+        execution_time = (time.monotonic() - started_at) / len(tasks)
+
+        # Write results
+        for current_task, (data, error, profile) in zip(tasks, outcomes):
+            name = self.pool.task_names.get(current_task["task"], "unknown")
+            self.pool.queue_wait.observe(started_at - queued_at, name)
+            self.pool.execution_time.observe(execution_time, name)
+            self.pool.completed.inc(name, "error" if error is not None else "done")
+
+            if error is not None:
+                self.write_error(dataset, current_task, error, profile)
+            else:
+                self.write_result(dataset, current_task, data, profile)
 
-            # Write result
-            self.write_result(task[0], data)
+        self.pool.release_dataset(dataset, len(tasks))
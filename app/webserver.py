@@ -3,16 +3,66 @@
     It initializes the Flask web server and the data ingestor.
 """
 
+import os
+
+from threading import Lock
 from flask import Flask
 from app.data_ingestor import DataIngestor
 from app.task_runner import ThreadPool
 from app.logs.log import instantiate_logger
+from app.metrics import Counter, Histogram
 
 webserver = Flask(__name__)
 
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+webserver.csv_path = os.getenv("DATA_CSV_PATH", "./nutrition_activity_obesity_usa_subset.csv")
+webserver.snapshot_dir = os.getenv("DATA_SNAPSHOT_DIR", "snapshots")
+
+# The admin routes only load csv files from this directory (by default, the one of DATA_CSV_PATH)
+webserver.data_dir = os.path.realpath(
+    os.getenv("DATA_DIR", os.path.dirname(os.path.abspath(webserver.csv_path))))
+
+webserver.data_ingestor = DataIngestor(webserver.csv_path, webserver.snapshot_dir)
 webserver.tasks_runner = ThreadPool(webserver.data_ingestor)
 
+# Held while a new version of the dataset is being ingested in the background
+webserver.reload_lock = Lock()
+webserver.reload_status = {"status": "idle"}
+
 webserver.job_counter = 1
 
+# Requests served by every route, exposed by /metrics
+webserver.requests = Counter("http_requests_total",
+                             "Requests served, by route, method and status.",
+                             ("route", "method", "status"))
+webserver.request_duration = Histogram("http_request_duration_seconds",
+                                       "Time spent answering requests, by route.", ("route",))
+
 logger = instantiate_logger()
+
+def reload_data_ingestor(csv_path: str, append: bool = False):
+    """
+        Ingest the given csv and swap it in as the dataset of the server or, with
+        append, add its rows to the current dataset.
+        Runs on a background thread, with reload_lock held by the caller.
+    """
+    try:
+        if append:
+            data_ingestor = webserver.data_ingestor.append_csv(csv_path)
+        else:
+            data_ingestor = DataIngestor(csv_path, webserver.snapshot_dir)
+
+        # A new generation, even after an append, so the cached results are dropped
+        # and the tasks queued before the swap keep the previous data ingestor
+        webserver.tasks_runner.reload(data_ingestor)
+
+        webserver.data_ingestor = data_ingestor
+        if not append:
+            webserver.csv_path = csv_path
+        webserver.reload_status = {"status": "idle"}
+        logger.info(f"{'Appended' if append else 'Reloaded'} the dataset from {csv_path}")
+    except Exception as e: # pylint: disable=broad-exception-caught
+        # Whatever went wrong, the status must leave "reloading"
+        webserver.reload_status = {"status": "error", "reason": str(e)}
+        logger.info(f"Failed to reload the dataset from {csv_path} - {e}")
+    finally:
+        webserver.reload_lock.release()
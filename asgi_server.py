@@ -0,0 +1,3 @@
+from app.asgi import application
+# ASGI entry point, an alternative to api_server.py, e.g.:
+#   uvicorn asgi_server:application
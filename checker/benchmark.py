@@ -0,0 +1,287 @@
+"""
+    Microbenchmarks of the data ingestor and of the task functions, over synthetic
+    datasets shaped like the CDC csv, at parameterized sizes.
+
+    For every size it records the time and the peak memory of the ingest, the time to
+    build the aggregates of every question, and the time of a call of each task. With
+    --check, the results are compared against a stored baseline and the run fails if
+    any of them regressed beyond --threshold.
+
+    Example:
+        python checker/benchmark.py --sizes 20000,200000,2000000 --states 60
+        python checker/benchmark.py --update-baseline
+        python checker/benchmark.py --check
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "checker", "benchmark_baseline.json")
+HEADER_CSV = os.path.join(ROOT, "unittests", "unittest_nutrition_activity_obesity_usa_subset.csv")
+
+STATES = [
+    "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado", "Connecticut",
+    "Delaware", "District of Columbia", "Florida", "Georgia", "Hawaii", "Idaho", "Illinois",
+    "Indiana", "Iowa", "Kansas", "Kentucky", "Louisiana", "Maine", "Maryland",
+    "Massachusetts", "Michigan", "Minnesota", "Mississippi", "Missouri", "Montana",
+    "Nebraska", "Nevada", "New Hampshire", "New Jersey", "New Mexico", "New York",
+    "North Carolina", "North Dakota", "Ohio", "Oklahoma", "Oregon", "Pennsylvania",
+    "Rhode Island", "South Carolina", "South Dakota", "Tennessee", "Texas", "Utah",
+    "Vermont", "Virginia", "Washington", "West Virginia", "Wisconsin", "Wyoming", "Guam",
+    "Puerto Rico", "Virgin Islands", "National",
+]
+
+STRATIFICATIONS = {
+    "Age (years)": ["18 - 24", "25 - 34", "35 - 44", "45 - 54", "55 - 64", "65 or older"],
+    "Education": ["Less than high school", "High school graduate",
+                  "Some college or technical school", "College graduate"],
+    "Gender": ["Male", "Female"],
+    "Income": ["Less than $15,000", "$15,000 - $24,999", "$25,000 - $34,999",
+               "$35,000 - $49,999", "$50,000 - $74,999", "$75,000 or greater",
+               "Data not reported"],
+    "Race/Ethnicity": ["Non-Hispanic White", "Non-Hispanic Black", "Hispanic", "Asian",
+                       "Hawaiian/Pacific Islander", "American Indian/Alaska Native",
+                       "2 or more races", "Other"],
+    "Total": ["Total"],
+}
+
+def generate_csv(path: str, rows: int, states: int, stratification_scale: int,
+                 questions: list, seed: int):
+    """
+        Write a csv with the header of the CDC dataset and random rows: the given number
+        of states (the real ones first), every stratification category with
+        stratification_scale times its real number of values, and the known questions.
+    """
+    rng = random.Random(seed)
+
+    with open(HEADER_CSV, "r", encoding="utf-8", newline="") as fin:
+        header = next(csv.reader(fin))
+
+    state_names = STATES[:states] + [f"State {index}" for index in range(len(STATES), states)]
+    stratifications = [
+        (category, value if scale == 0 else f"{value} ({scale})")
+        for category, values in STRATIFICATIONS.items()
+        for value in values
+        for scale in range(stratification_scale)
+    ]
+    columns = {name: index for index, name in enumerate(header)}
+
+    with open(path, "w", encoding="utf-8", newline="") as fout:
+        writer = csv.writer(fout)
+        writer.writerow(header)
+
+        for index in range(rows):
+            row = [""] * len(header)
+            year = rng.randint(2011, 2022)
+            category, value = rng.choice(stratifications)
+
+            row[0] = str(index)
+            row[columns["YearStart"]] = row[columns["YearEnd"]] = str(year)
+            row[columns["LocationDesc"]] = rng.choice(state_names)
+            row[columns["Question"]] = rng.choice(questions)
+            row[columns["Data_Value"]] = f"{rng.uniform(5, 80):.1f}"
+            row[columns["StratificationCategory1"]] = category
+            row[columns["Stratification1"]] = value
+            writer.writerow(row)
+
+def best_time(function, calls: int, rounds: int) -> float:
+    """
+        Return the time of a round of calls of the function, the best of rounds rounds.
+    """
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchmark_size(csv_path: str, args, modules) -> dict:
+    """
+        Run the benchmarks on the given csv.
+    """
+    data_ingestor_class, task_mapper, task_names = modules
+
+    start = time.perf_counter()
+    data_ingestor = data_ingestor_class(csv_path)
+    ingest_time = time.perf_counter() - start
+
+    # Tracing the allocations slows the ingest down, so the memory is measured
+    # on a second, separate ingest
+    tracemalloc.start()
+    data_ingestor_class(csv_path)
+    _, ingest_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    data_ingestor.build_aggregates()
+    aggregates_time = time.perf_counter() - start
+
+    # Every task is called for each question and a few of its states
+    requests = [
+        {"question": question, "state": state}
+        for question in data_ingestor.questions.values
+        for state in list(data_ingestor.aggregate(question).states)[:5]
+    ]
+
+    # A single call of a task is too short to compare against the noise of the timer,
+    # so the regressions are checked on the time of a whole round of requests
+    tasks, rounds = {}, {}
+    for task, function in task_mapper.items():
+        def run(function=function):
+            for request in requests:
+                function(data_ingestor, request)
+
+        rounds[task_names[task]] = best_time(run, args.calls, args.rounds)
+        tasks[task_names[task]] = rounds[task_names[task]] / (args.calls * len(requests))
+
+    return {
+        "rows": len(data_ingestor.values),
+        "ingest_seconds": ingest_time,
+        "ingest_peak_bytes": ingest_peak,
+        "aggregates_seconds": aggregates_time,
+        "task_seconds": tasks,
+        "task_round_seconds": rounds,
+    }
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta: float) -> list:
+    """
+        Return the description of every result that is more than threshold (relative)
+        and min_delta seconds worse than the baseline, for the sizes found in both.
+    """
+    regressions = []
+
+    def check(name, current, previous, seconds=True):
+        if current > previous * (1 + threshold) and (not seconds or current - previous > min_delta):
+            regressions.append(f"{name}: {current:.6g} vs {previous:.6g} in the baseline")
+
+    for size, result in results["sizes"].items():
+        previous = baseline["sizes"].get(size)
+        if previous is None:
+            continue
+
+        check(f"{size} rows ingest_seconds", result["ingest_seconds"],
+              previous["ingest_seconds"])
+        check(f"{size} rows ingest_peak_bytes", result["ingest_peak_bytes"],
+              previous["ingest_peak_bytes"], seconds=False)
+        check(f"{size} rows aggregates_seconds", result["aggregates_seconds"],
+              previous["aggregates_seconds"])
+        previous_rounds = previous.get("task_round_seconds", {})
+        for task, seconds in result["task_round_seconds"].items():
+            if task in previous_rounds:
+                check(f"{size} rows {task} round", seconds, previous_rounds[task])
+
+    return regressions
+
+def print_results(results: dict):
+    """
+        Print a human-readable table of the results.
+    """
+    for size, result in results["sizes"].items():
+        print(f"{size} rows: ingest {result['ingest_seconds']:.3f}s "
+              f"(peak {result['ingest_peak_bytes'] / 2 ** 20:.1f} MiB), "
+              f"aggregates {result['aggregates_seconds']:.3f}s")
+        for task, seconds in result["task_seconds"].items():
+            print(f"    {task:<24}{seconds * 1e6:>10.2f} us/call")
+
+def main():
+    """
+        Parse the arguments, run the benchmarks and compare them against the baseline.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks of the data ingestor and tasks")
+    parser.add_argument("--sizes", default="20000,200000", help="rows of the datasets")
+    parser.add_argument("--states", type=int, default=len(STATES))
+    parser.add_argument("--stratification-scale", type=int, default=1,
+                        help="multiply the number of values of each stratification category")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--calls", type=int, default=20,
+                        help="calls of each task per request and round")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="fail if a result regressed against the baseline")
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="relative slowdown that counts as a regression")
+    parser.add_argument("--min-delta", type=float, default=2e-5,
+                        help="seconds below which the slowdown of a timed interval (an "
+                             "ingest, the aggregates or a round of task calls) is noise")
+    args = parser.parse_args()
+
+    config = {
+        "states": args.states,
+        "stratification_scale": args.stratification_scale,
+        "seed": args.seed,
+        "calls": args.calls,
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Importing the app starts the server, so it is pointed at the small unittest csv
+        os.environ["DATA_CSV_PATH"] = HEADER_CSV
+        os.environ["DATA_SNAPSHOT_DIR"] = directory
+        sys.path.insert(0, ROOT)
+
+        # pylint: disable=import-outside-toplevel
+        from app import webserver
+        from app.data_ingestor import DataIngestor
+        from app.task_runner import get_task_mapper
+        from app import constants as const
+
+        modules = (DataIngestor, get_task_mapper(),
+                   {task: name for name, task in const.get_task_constants()})
+        questions = DataIngestor(HEADER_CSV).questions.values
+
+        results = {"config": config, "sizes": {}}
+        try:
+            for size in (int(size) for size in args.sizes.split(",")):
+                csv_path = os.path.join(directory, f"{size}.csv")
+                generate_csv(csv_path, size, args.states, args.stratification_scale,
+                             questions, args.seed)
+                results["sizes"][str(size)] = benchmark_size(csv_path, args, modules)
+                os.remove(csv_path)
+        finally:
+            webserver.tasks_runner.graceful_shutdown()
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fout:
+            json.dump(results, fout, indent=4)
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as fout:
+            json.dump(results, fout, indent=4)
+        print(f"Stored the results as the baseline in {args.baseline}")
+
+    if args.check:
+        with open(args.baseline, "r", encoding="utf-8") as fin:
+            baseline = json.load(fin)
+
+        # A check that has nothing to compare fails, with its own exit status
+        if baseline["config"] != config:
+            print("The baseline was recorded with another configuration, nothing to compare")
+            sys.exit(2)
+
+        if not results["sizes"].keys() & baseline["sizes"].keys():
+            print("None of the sizes is in the baseline, nothing to compare")
+            sys.exit(2)
+
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regression against the baseline")
+
+if __name__ == '__main__':
+    main()
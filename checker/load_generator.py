@@ -0,0 +1,326 @@
+"""
+    Load generator for the webserver, built on the checker's tests/<endpoint>/input payloads.
+
+    Closed loop: --concurrency clients each submit a request, wait for its result and
+    start the next one. Open loop: requests arrive at --rate per second (Poisson
+    arrivals), whether or not the previous ones are done; the latencies are measured
+    from the scheduled arrival, so a saturated server isn't hidden by the generator
+    falling behind.
+
+    Example:
+        python checker/load_generator.py --mode open --rate 200 --duration 30 \\
+            --mix state_mean=4,mean_by_category=1 --output load.json
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ENDPOINTS = [
+    "states_mean", "state_mean", "best5", "worst5", "global_mean", "diff_from_mean",
+    "state_diff_from_mean", "mean_by_category", "state_mean_by_category",
+]
+
+# Seconds a client waits on a single ?wait= long poll of /api/get_results
+POLL_WAIT = 5
+
+def load_payloads(tests_dir: str) -> dict:
+    """
+        Read the request payloads of every endpoint from tests/<endpoint>/input.
+    """
+    payloads = {}
+    for endpoint in ENDPOINTS:
+        input_dir = os.path.join(tests_dir, endpoint, "input")
+        payloads[endpoint] = []
+        for input_file in sorted(os.listdir(input_dir)):
+            with open(os.path.join(input_dir, input_file), "r", encoding="utf-8") as fin:
+                payloads[endpoint].append(json.load(fin))
+    return payloads
+
+def parse_mix(mix: str) -> dict:
+    """
+        Parse a task mix such as "state_mean=4,best5=1" into endpoint -> weight.
+        An empty mix sends the nine endpoints in equal shares.
+    """
+    if not mix:
+        return {endpoint: 1.0 for endpoint in ENDPOINTS}
+
+    weights = {}
+    for item in mix.split(","):
+        endpoint, _, weight = item.partition("=")
+        if endpoint.strip() not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint in mix: {endpoint}")
+        weights[endpoint.strip()] = float(weight or 1)
+    return weights
+
+def percentile(values: list, fraction: float):
+    """
+        Return the nearest-rank percentile of the values, or None if there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(values: list) -> dict:
+    """
+        Return the count, mean and p50/p95/p99/max of the latencies, in milliseconds.
+    """
+    summary = {"count": len(values)}
+    if values:
+        summary["mean"] = 1000 * sum(values) / len(values)
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)):
+            summary[name] = 1000 * percentile(values, fraction)
+    return summary
+
+class LoadGenerator:
+    """
+        Drive the endpoints of the server and record the outcome of every request.
+    """
+
+    def __init__(self, args):
+        self.url = args.url.rstrip("/")
+        self.timeout = args.timeout
+        self.payloads = load_payloads(args.tests_dir)
+
+        mix = parse_mix(args.mix)
+        self.endpoints = list(mix)
+        self.weights = [mix[endpoint] for endpoint in self.endpoints]
+
+        self.sessions = threading.local()
+        self.lock = threading.Lock()
+        self.random = random.Random(args.seed)
+
+        # Outcome of the requests, per endpoint
+        self.submit_latencies = {endpoint: [] for endpoint in self.endpoints}
+        self.done_latencies = {endpoint: [] for endpoint in self.endpoints}
+        self.errors = {}
+
+    def session(self) -> requests.Session:
+        """
+            Return the HTTP session of the calling thread, to reuse its connections.
+        """
+        if not hasattr(self.sessions, "session"):
+            self.sessions.session = requests.Session()
+        return self.sessions.session
+
+    def pick(self) -> tuple:
+        """
+            Pick the endpoint and the payload of the next request from the mix.
+        """
+        with self.lock:
+            endpoint = self.random.choices(self.endpoints, self.weights)[0]
+            return endpoint, self.random.choice(self.payloads[endpoint])
+
+    def error(self, endpoint: str, kind: str):
+        """
+            Count an error of the given kind.
+        """
+        with self.lock:
+            key = f"{endpoint}:{kind}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def run_request(self, scheduled_at: float = None):
+        """
+            Submit a request and wait until its job is done. The latencies are measured
+            from scheduled_at when given (open loop), or from the submission.
+        """
+        endpoint, payload = self.pick()
+        session = self.session()
+        started_at = time.perf_counter() if scheduled_at is None else scheduled_at
+
+        try:
+            response = session.post(f"{self.url}/api/{endpoint}", json=payload,
+                                    timeout=self.timeout)
+            submitted_at = time.perf_counter()
+            if response.status_code != 200:
+                self.error(endpoint, f"http_{response.status_code}")
+                return
+
+            job_id = response.json()["job_id"]
+            if job_id == -1:
+                self.error(endpoint, "rejected")
+                return
+
+            deadline = started_at + self.timeout
+            while True:
+                response = session.get(f"{self.url}/api/get_results/{job_id}",
+                                       params={"wait": POLL_WAIT}, timeout=POLL_WAIT + 5)
+                status = response.json()["status"]
+                if status != "running":
+                    break
+                if time.perf_counter() > deadline:
+                    self.error(endpoint, "timeout")
+                    return
+        except (requests.RequestException, ValueError, KeyError):
+            self.error(endpoint, "connection")
+            return
+
+        done_at = time.perf_counter()
+        if status != "done":
+            self.error(endpoint, "job_error")
+            return
+
+        with self.lock:
+            self.submit_latencies[endpoint].append(submitted_at - started_at)
+            self.done_latencies[endpoint].append(done_at - started_at)
+
+    def run_closed(self, concurrency: int, duration: float, total: int):
+        """
+            Run concurrency clients that send requests back to back.
+        """
+        end = time.perf_counter() + duration
+        counter = iter(range(total)) if total else None
+
+        def client():
+            while time.perf_counter() < end:
+                if counter is not None and next(counter, None) is None:
+                    return
+                self.run_request()
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open(self, rate: float, duration: float, total: int, max_in_flight: int):
+        """
+            Send requests at Poisson arrivals of the given rate, regardless of how many
+            are still in flight (up to max_in_flight at once).
+        """
+        start = time.perf_counter()
+        scheduled_at = start
+        sent = 0
+
+        with ThreadPoolExecutor(max_in_flight) as executor:
+            while scheduled_at - start < duration and (not total or sent < total):
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                executor.submit(self.run_request, scheduled_at)
+                sent += 1
+                scheduled_at += self.random.expovariate(rate)
+
+    def report(self, args, elapsed: float) -> dict:
+        """
+            Build the machine-readable results of the run.
+        """
+        submit = [value for values in self.submit_latencies.values() for value in values]
+        done = [value for values in self.done_latencies.values() for value in values]
+
+        return {
+            "label": args.label,
+            "version": git_version(),
+            "config": {
+                "url": self.url,
+                "mode": args.mode,
+                "concurrency": args.concurrency,
+                "rate": args.rate,
+                "duration": args.duration,
+                "requests": args.requests,
+                "mix": dict(zip(self.endpoints, self.weights)),
+            },
+            "elapsed": elapsed,
+            "completed": len(done),
+            "errors": sum(self.errors.values()),
+            "error_counts": dict(sorted(self.errors.items())),
+            "jobs_per_second": len(done) / elapsed if elapsed else 0,
+            "submit_latency_ms": summarize(submit),
+            "done_latency_ms": summarize(done),
+            "endpoints": {
+                endpoint: {
+                    "submit_latency_ms": summarize(self.submit_latencies[endpoint]),
+                    "done_latency_ms": summarize(self.done_latencies[endpoint]),
+                }
+                for endpoint in self.endpoints
+            },
+        }
+
+def git_version():
+    """
+        Return the commit the server code is at, to compare runs across versions.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(results: dict):
+    """
+        Print a human-readable summary of the results.
+    """
+    print(f"{results['completed']} jobs in {results['elapsed']:.1f}s "
+          f"({results['jobs_per_second']:.1f} jobs/s), {results['errors']} errors")
+    for kind, count in results["error_counts"].items():
+        print(f"  {kind}: {count}")
+
+    print(f"{'endpoint':<24}{'count':>7}{'submit p50':>12}{'p99':>9}"
+          f"{'done p50':>11}{'p95':>9}{'p99':>9}")
+    rows = dict(results["endpoints"], all={
+        "submit_latency_ms": results["submit_latency_ms"],
+        "done_latency_ms": results["done_latency_ms"],
+    })
+    for endpoint, latencies in rows.items():
+        submit, done = latencies["submit_latency_ms"], latencies["done_latency_ms"]
+        if not done["count"]:
+            continue
+        print(f"{endpoint:<24}{done['count']:>7}{submit['p50']:>12.2f}{submit['p99']:>9.2f}"
+              f"{done['p50']:>11.2f}{done['p95']:>9.2f}{done['p99']:>9.2f}")
+
+def main():
+    """
+        Parse the arguments, run the load and report the results.
+    """
+    parser = argparse.ArgumentParser(description="Load generator for the webserver")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--tests-dir", default="tests")
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="clients of the closed loop")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="requests per second of the open loop")
+    parser.add_argument("--max-in-flight", type=int, default=256,
+                        help="requests in flight at once in the open loop")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--requests", type=int, default=0,
+                        help="stop after this many requests (0 for no limit)")
+    parser.add_argument("--mix", default="",
+                        help="task mix, e.g. state_mean=4,mean_by_category=1")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds after which a request counts as timed out")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--label", default=os.getenv("TP_NUM_OF_THREADS"),
+                        help="name of the run in the results (TP_NUM_OF_THREADS by default)")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args)
+
+    start = time.perf_counter()
+    if args.mode == "closed":
+        generator.run_closed(args.concurrency, args.duration, args.requests)
+    else:
+        generator.run_open(args.rate, args.duration, args.requests, args.max_in_flight)
+    elapsed = time.perf_counter() - start
+
+    results = generator.report(args, elapsed)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fout:
+            json.dump(results, fout, indent=4)
+
+if __name__ == '__main__':
+    main()
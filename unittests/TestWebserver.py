@@ -1,55 +1,49 @@
-import unittest
+import asyncio
+import contextlib
+import cProfile
 import csv
+import gzip
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
 from app.tasks import *
+from app.data_ingestor import DataIngestor
+from app.snapshot import snapshot_path
+from app.task_runner import ThreadPool, TaskRunner, QueueFullError, profile_key
+from app.task_runner import execute_tasks, get_task_mapper
+from app.result_store import MemoryResultStore
+from app.metrics import Counter, Histogram
+from app.scheduler import TaskScheduler
+from app.job_registry import JobRegistry
+from app.logs.log import AsyncQueueHandler, SamplingFilter
+from app.asgi import application
+from app.asgi import wait_for_job as asgi_wait_for_job
+from app.serialization import dumps, envelope, compress, accepted_encoding
+from app.webserver import webserver as ws
+from app.webserver import reload_data_ingestor
+from app.webserver import logger as ws_logger
+from app import constants as const
 
 class TestWebserver(unittest.TestCase):
     
     def setUp(self):
-        self.questions_best_is_min = [
-            'Percent of adults aged 18 years and older who have an overweight classification',
-            'Percent of adults aged 18 years and older who have obesity',
-            'Percent of adults who engage in no leisure-time physical activity',
-            'Percent of adults who report consuming fruit less than one time daily',
-            'Percent of adults who report consuming vegetables less than one time daily'
-        ]
+        self.data_ingestor = DataIngestor("unittests/unittest_nutrition_activity_obesity_usa_subset.csv")
 
-        self.questions_best_is_max = [
-            'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
-            'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic physical activity and engage in muscle-strengthening activities on 2 or more days a week',
-            'Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
-            'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
-        ]
-        
-        with open("unittests/unittest_nutrition_activity_obesity_usa_subset.csv", 'r') as file:
-            reader = csv.DictReader(file)
-            csv_data = list(reader)
-
-        self.data = {q: {} for q in self.questions_best_is_max + self.questions_best_is_min}
-
-        for entry in csv_data:
-            important_data = {
-                "YearStart": entry["YearStart"],
-                "YearEnd": entry["YearEnd"],
-                "DataValue": entry["Data_Value"],
-                "LocationAbbr": entry["LocationAbbr"],
-                "LocationDesc": entry["LocationDesc"],
-                "StratificationCategory1": entry["StratificationCategory1"],
-                "Stratification1": entry["Stratification1"],
-            }
-
-            locD = entry["LocationDesc"]
-            
-            if locD not in self.data[entry["Question"]]:
-                self.data[entry["Question"]][locD] = [important_data]
-            else:
-                self.data[entry["Question"]][locD].append(important_data)
-                
     def test_states_mean(self):
         data = {
             "question": "Percent of adults who engage in no leisure-time physical activity"
         }
         
-        self.assertEqual(states_mean(self, data), {"Kentucky": 22.9, "New Hampshire": 23.4, "Louisiana": 24.9, "Iowa": 25.2, "Massachusetts": 26.5, "Arkansas": 31.9, "North Carolina": 42.7})
+        self.assertEqual(states_mean(self.data_ingestor, data), {"Kentucky": 22.9, "New Hampshire": 23.4, "Louisiana": 24.9, "Iowa": 25.2, "Massachusetts": 26.5, "Arkansas": 31.9, "North Carolina": 42.7})
         
     def test_state_mean(self):
         data = {
@@ -57,35 +51,35 @@ class TestWebserver(unittest.TestCase):
             "state": "Kentucky"
         }
         
-        self.assertEqual(state_mean(self, data), {"Kentucky": 22.9})
+        self.assertEqual(state_mean(self.data_ingestor, data), {"Kentucky": 22.9})
         
     def test_best5(self):
         data = {
             "question": "Percent of adults who engage in no leisure-time physical activity"
         }
         
-        self.assertEqual(best5(self, data), {"Kentucky": 22.9, "New Hampshire": 23.4, "Louisiana": 24.9, "Iowa": 25.2, "Massachusetts": 26.5})
+        self.assertEqual(best5(self.data_ingestor, data), {"Kentucky": 22.9, "New Hampshire": 23.4, "Louisiana": 24.9, "Iowa": 25.2, "Massachusetts": 26.5})
         
     def test_worst5(self):
         data = {
             "question": "Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)"
         }
         
-        self.assertEqual(worst5(self, data), {"Idaho": 46.4, "Connecticut": 55.2})
+        self.assertEqual(worst5(self.data_ingestor, data), {"Idaho": 46.4, "Connecticut": 55.2})
         
     def test_global_mean(self):
         data = {
             "question": "Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)"
         }
         
-        self.assertEqual(global_mean(self, data), {"global_mean": 50.8})
+        self.assertEqual(global_mean(self.data_ingestor, data), {"global_mean": 50.8})
         
     def test_diff_from_mean(self):
         data = {
             "question": "Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)"
         }
         
-        self.assertEqual(diff_from_mean(self, data), {"Idaho": 4.399999999999999, "Connecticut": -4.400000000000006})
+        self.assertEqual(diff_from_mean(self.data_ingestor, data), {"Idaho": 4.399999999999999, "Connecticut": -4.400000000000006})
         
     def test_state_diff_from_mean(self):
         data = {
@@ -93,14 +87,14 @@ class TestWebserver(unittest.TestCase):
             "state": "Idaho"
         }
         
-        self.assertEqual(state_diff_from_mean(self, data), {"Idaho": 4.399999999999999})
+        self.assertEqual(state_diff_from_mean(self.data_ingestor, data), {"Idaho": 4.399999999999999})
         
     def test_mean_by_category(self):
         data = {
             "question": "Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)"
         }
         
-        self.assertEqual(mean_by_category(self, data), {"('Connecticut', 'Race/Ethnicity', 'Non-Hispanic White')": 55.2, "('Idaho', 'Education', 'Less than high school')": 46.4})
+        self.assertEqual(mean_by_category(self.data_ingestor, data), {"('Connecticut', 'Race/Ethnicity', 'Non-Hispanic White')": 55.2, "('Idaho', 'Education', 'Less than high school')": 46.4})
         
     def test_state_mean_by_category(self):
         data = {
@@ -108,7 +102,716 @@ class TestWebserver(unittest.TestCase):
             "state": "Connecticut"
         }
         
-        self.assertEqual(state_mean_by_category(self, data), {"Connecticut": {"('Race/Ethnicity', 'Non-Hispanic White')": 55.2}})
+        self.assertEqual(state_mean_by_category(self.data_ingestor, data), {"Connecticut": {"('Race/Ethnicity', 'Non-Hispanic White')": 55.2}})
         
+    def test_mean_by_category_quoted_keys(self):
+        with open("unittests/unittest_nutrition_activity_obesity_usa_subset.csv", encoding="utf-8") as f:
+            csv_data = f.read().replace("Connecticut", "Connecticut's")
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", encoding="utf-8") as f:
+            f.write(csv_data)
+            f.flush()
+            data_ingestor = DataIngestor(f.name)
+
+        data = {
+            "question": "Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)"
+        }
+
+        self.assertEqual(list(mean_by_category(data_ingestor, data)), ["(\"Connecticut's\", 'Race/Ethnicity', 'Non-Hispanic White')", "('Idaho', 'Education', 'Less than high school')"])
+
+    def test_data_ingestor_columns(self):
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        rows = self.data_ingestor.question_slice(question)
+
+        self.assertEqual(self.data_ingestor.values.dtype, np.float64)
+        self.assertEqual(rows.stop - rows.start, 7)
+        self.assertEqual(list(self.data_ingestor.state_slices(question))[0], "Arkansas")
+        self.assertTrue(all(
+            self.data_ingestor.question[rows] == self.data_ingestor.questions.codes[question]))
+
+    def test_data_ingestor_blank_and_short_lines(self):
+        with open("unittests/unittest_nutrition_activity_obesity_usa_subset.csv", encoding="utf-8", newline="") as f:
+            lines = f.readlines()
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", encoding="utf-8") as f:
+            f.writelines(lines[:5] + ["\n"] + lines[5:] + ["\n", "\n"])
+            f.flush()
+            data_ingestor = DataIngestor(f.name)
+
+        self.assertEqual(len(data_ingestor.values), len(self.data_ingestor.values))
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", encoding="utf-8") as f:
+            f.writelines(lines + ["1,2011,2011,AL\n"])
+            f.flush()
+            with self.assertRaisesRegex(ValueError, f"Line {len(lines) + 1} of"):
+                DataIngestor(f.name)
+
+    def test_snapshot(self):
+        csv_path = "unittests/unittest_nutrition_activity_obesity_usa_subset.csv"
+        data = {
+            "question": "Percent of adults who engage in no leisure-time physical activity"
+        }
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            DataIngestor(csv_path, snapshot_dir)
+            self.assertTrue(os.path.isdir(snapshot_path(csv_path, snapshot_dir)))
+
+            # A csv with the same name in another directory has its own snapshot
+            self.assertNotEqual(snapshot_path(csv_path, snapshot_dir),
+                                snapshot_path(os.path.join("other", os.path.basename(csv_path)), snapshot_dir))
+
+            with mock.patch.object(DataIngestor, "process_csv_data") as process_csv_data:
+                data_ingestor = DataIngestor(csv_path, snapshot_dir)
+
+            process_csv_data.assert_not_called()
+            self.assertIsInstance(data_ingestor.values, np.memmap)
+            self.assertFalse(data_ingestor.values.flags.writeable)
+            self.assertEqual(data_ingestor.states.values, self.data_ingestor.states.values)
+            self.assertEqual(data_ingestor.state_offsets, self.data_ingestor.state_offsets)
+            self.assertEqual(mean_by_category(data_ingestor, data), mean_by_category(self.data_ingestor, data))
+
+        # Without a usable snapshot directory, the columns stay in memory
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            not_a_dir = os.path.join(snapshot_dir, "file")
+            open(not_a_dir, "w", encoding="utf-8").close()
+            data_ingestor = DataIngestor(csv_path, os.path.join(not_a_dir, "snapshots"))
+            self.assertEqual(data_ingestor.state_offsets, self.data_ingestor.state_offsets)
+
+            with mock.patch("app.data_ingestor.save_snapshot", side_effect=OSError("No space left on device")):
+                data_ingestor = DataIngestor(csv_path, snapshot_dir)
+            self.assertNotIsInstance(data_ingestor.values, np.memmap)
+            self.assertEqual(mean_by_category(data_ingestor, data), mean_by_category(self.data_ingestor, data))
+
+        with self.assertRaises(FileNotFoundError):
+            DataIngestor("unittests/missing.csv", "/proc/nosnap")
+
+    def test_aggregate(self):
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        aggregate = self.data_ingestor.aggregate(question)
+
+        self.assertIs(self.data_ingestor.aggregate(question), aggregate)
+        self.assertEqual(aggregate.total[1], 7)
+        self.assertEqual(aggregate.states["Kentucky"], (22.9, 1))
+        self.assertEqual(list(aggregate.categories["Kentucky"]), [("Age (years)", "25 - 34")])
+        self.assertEqual(aggregate.states_ascending[0], ("Kentucky", 22.9))
+        self.assertEqual(aggregate.states_descending[0], ("North Carolina", 42.7))
+        self.assertEqual(aggregate.all_category_means[0][0], ("Arkansas", "Race/Ethnicity", "Non-Hispanic White"))
+
+    def test_append_rows(self):
+        with open("unittests/unittest_nutrition_activity_obesity_usa_subset.csv", encoding="utf-8", newline="") as f:
+            lines = f.readlines()
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", encoding="utf-8") as f:
+            f.writelines(lines[:11])
+            f.flush()
+            data_ingestor = DataIngestor(f.name)
+
+        # Some aggregates are updated by the appends, the others are built afterwards
+        questions = self.data_ingestor.questions.values
+        for question in questions[::2]:
+            data_ingestor.aggregate(question)
+        original = {question: data_ingestor.aggregate(question) for question in questions[::2]}
+
+        appended = data_ingestor.append_rows(csv.DictReader(lines[:1] + lines[11:20]))
+        appended = appended.append_rows(csv.DictReader(lines[:1] + lines[20:]))
+
+        # The original data ingestor is untouched and its columns are shared
+        self.assertEqual(len(data_ingestor.values), 10)
+        self.assertEqual(data_ingestor.segments, [])
+        self.assertEqual(data_ingestor.aggregates, original)
+        self.assertIs(appended.values, data_ingestor.values)
+        self.assertEqual(len(appended.segments), 2)
+
+        for question in questions:
+            data = {"question": question}
+            expected = mean_by_category(self.data_ingestor, data)
+            result = mean_by_category(appended, data)
+            self.assertEqual(list(result), list(expected))
+            for key, value in expected.items():
+                self.assertAlmostEqual(result[key], value)
+
+            expected = states_mean(self.data_ingestor, data)
+            result = states_mean(appended, data)
+            self.assertEqual(list(result), list(expected))
+            for key, value in expected.items():
+                self.assertAlmostEqual(result[key], value)
+
+    def test_append_rows_invalid(self):
+        with self.assertRaises(ValueError):
+            self.data_ingestor.append_rows([{
+                "Data_Value": "not a number", "YearStart": "2011", "YearEnd": "2011",
+                "Question": "New question", "LocationDesc": "New state",
+                "StratificationCategory1": "", "Stratification1": "",
+            }])
+
+        self.assertFalse(self.data_ingestor.has_question("New question"))
+        self.assertNotIn("New state", self.data_ingestor.states)
+
+    def test_process_backend(self):
+        data = {
+            "task": const.GLOBAL_MEAN,
+            "question": "Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)"
+        }
+
+        with self.thread_pool(TP_BACKEND="process", TP_NUM_OF_THREADS="2") as pool:
+            self.assertEqual(pool.threads[0].execute_tasks(pool.dataset, [data]), [({"global_mean": 50.8}, None, None)])
+
+    def test_serialization(self):
+        payload = dumps({"Kentucky": np.float64(22.9), "('Income', 'Total')": 1.5})
+        self.assertEqual(payload, b'{"Kentucky":22.9,"(\'Income\', \'Total\')":1.5}')
+        self.assertEqual(json.loads(envelope(payload)), {"status": "done", "data": json.loads(payload)})
+        with mock.patch("app.serialization.orjson", None):
+            self.assertEqual(dumps({"Kentucky": np.float64(22.9), "('Income', 'Total')": 1.5}), payload)
+
+        # NaN has no JSON notation, so both encoders write null
+        for orjson in (sys.modules.get("orjson"), None):
+            with mock.patch("app.serialization.orjson", orjson):
+                self.assertEqual(dumps({"global_mean": float("nan"), "values": [np.float64("inf")]}),
+                                 b'{"global_mean":null,"values":[null]}')
+
+        self.assertEqual(accepted_encoding("deflate, gzip;q=0.5"), "gzip")
+        self.assertEqual(accepted_encoding("gzip;q=0, deflate"), "deflate")
+        self.assertIsNone(accepted_encoding("br"))
+        self.assertIsNone(accepted_encoding(None))
+
+        large = dumps({str(index): index / 7 for index in range(200)})
+        body, coding = compress(large, "gzip")
+        self.assertEqual((gzip.decompress(body), coding), (large, "gzip"))
+        self.assertEqual(compress(payload, "gzip"), (payload, None))
+
+    def test_profile_unavailable(self):
+        data = {
+            "task": const.STATE_MEAN,
+            "question": "Percent of adults who engage in no leisure-time physical activity",
+            "state": "Kentucky",
+            "profile": True
+        }
+
+        # e.g. another profiling tool is active, which Python 3.12+ doesn't allow
+        with mock.patch.object(cProfile.Profile, "enable",
+                               side_effect=ValueError("Another profiling tool is already active")):
+            (result, error, profile), = execute_tasks(get_task_mapper(), self.data_ingestor, [data])
+
+        self.assertEqual((result, error), ({"Kentucky": 22.9}, None))
+        self.assertEqual(profile, "Not profiled: Another profiling tool is already active\n")
+
+    def test_memory_result_store_eviction(self):
+        store = MemoryResultStore(max_bytes=10, max_age=60)
+        store.put(0, b"12345")
+        store.put(1, b"12345")
+        store.get(0)
+        store.put(2, b"12345")
+
+        self.assertEqual(store.get(0), b"12345")
+        self.assertIsNone(store.get(1))
+        self.assertEqual(store.size, 10)
+
+        store = MemoryResultStore(max_bytes=10, max_age=0)
+        store.put(0, b"12345")
+        self.assertIsNone(store.get(0))
+        self.assertEqual(store.size, 0)
+
+    def test_memory_result_store_spill(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            store = MemoryResultStore(max_bytes=5, max_age=60, spill_dir=spill_dir)
+            store.put(0, b"12345")
+            store.put(1, b"67890")
+
+            self.assertEqual(len(store), 1)
+            self.assertEqual(store.get(0), b"12345")
+            self.assertEqual(store.get(1), b"67890")
+
+    @contextlib.contextmanager
+    def thread_pool(self, **env):
+        with mock.patch.dict(os.environ, env):
+            pool = ThreadPool(self.data_ingestor)
+
+        try:
+            yield pool
+        finally:
+            pool.graceful_shutdown()
+
+    @contextlib.contextmanager
+    def blocked_tasks(self, executed=None):
+        # The workers hold their tasks until release is set; started is set once one got a task
+        release = threading.Event()
+        started = threading.Event()
+        original_execute_tasks = TaskRunner.execute_tasks
+
+        def blocking_execute_tasks(runner, dataset, tasks):
+            if executed is not None:
+                executed.extend(tasks)
+            started.set()
+            release.wait(5)
+            return original_execute_tasks(runner, dataset, tasks)
+
+        with mock.patch.object(TaskRunner, "execute_tasks", blocking_execute_tasks):
+            try:
+                yield release, started
+            finally:
+                release.set()
+
+    def wait_for_job(self, pool, job_id):
+        for _ in range(500):
+            if pool.jobs[job_id]["status"] != "running":
+                return
+            time.sleep(0.01)
+        self.fail("Job did not finish")
+
+    def test_result_cache(self):
+        data = {
+            "task": const.STATE_MEAN,
+            "question": "Percent of adults who engage in no leisure-time physical activity",
+            "state": "Kentucky"
+        }
+
+        with self.thread_pool(RESULT_CACHE_SIZE="1", TP_NUM_OF_THREADS="1") as pool:
+            _, first_job_id = pool.submit_task(**data)
+            self.wait_for_job(pool, first_job_id)
+
+            _, job_id = pool.submit_task(**data)
+            self.assertEqual(pool.jobs[job_id]["status"], "done")
+            self.assertEqual(pool.result_store.get(job_id), b'{"Kentucky":22.9}')
+            self.assertEqual((pool.result_cache.hits, pool.result_cache.misses), (1, 1))
+
+            pool.result_cache.invalidate()
+            _, job_id = pool.submit_task(**data)
+            self.assertEqual(pool.jobs[job_id]["status"], "running")
+            self.wait_for_job(pool, job_id)
+
+    def test_single_flight(self):
+        data = {
+            "task": const.MEAN_BY_CATEGORY,
+            "question": "Percent of adults who engage in no leisure-time physical activity"
+        }
+        executed = []
+
+        with self.thread_pool(RESULT_CACHE_SIZE="0", TP_NUM_OF_THREADS="2") as pool:
+            with self.blocked_tasks(executed) as (release, _):
+                job_ids = [pool.submit_task(**data)[1] for _ in range(5)]
+                release.set()
+                for job_id in job_ids:
+                    self.wait_for_job(pool, job_id)
+
+            self.assertEqual(len(executed), 1)
+            self.assertEqual(len(set(job_ids)), 5)
+            self.assertEqual(len({pool.result_store.get(job_id) for job_id in job_ids}), 1)
+            self.assertEqual(pool.in_flight, {})
+
+    def test_wait_for_job(self):
+        data = {
+            "task": const.GLOBAL_MEAN,
+            "question": "Percent of adults who engage in no leisure-time physical activity"
+        }
+
+        with self.thread_pool(TP_NUM_OF_THREADS="1") as pool:
+            with self.blocked_tasks() as (release, _):
+                _, job_id = pool.submit_task(**data)
+
+                pool.wait_for_job(job_id, 0.05)
+                self.assertEqual(pool.jobs[job_id]["status"], "running")
+
+                threading.Timer(0.05, release.set).start()
+                pool.wait_for_job(job_id, 5)
+                self.assertEqual(pool.jobs[job_id]["status"], "done")
+                self.assertEqual(pool.job_waiters, {})
+
+    def test_submit_batch(self):
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        other_question = "Percent of adults aged 18 years and older who have obesity"
+        tasks = [
+            {"task": const.BEST5, "question": question},
+            {"task": const.GLOBAL_MEAN, "question": other_question},
+            {"task": const.STATE_MEAN, "question": question, "state": "Kentucky"},
+            {"task": const.WORST5, "question": "Invalid"},
+        ]
+        groups = []
+        original_execute_tasks = TaskRunner.execute_tasks
+
+        def recording_execute_tasks(runner, dataset, tasks):
+            groups.append(len(tasks))
+            return original_execute_tasks(runner, dataset, tasks)
+
+        with self.thread_pool(TP_NUM_OF_THREADS="1") as pool:
+            with mock.patch.object(TaskRunner, "execute_tasks", recording_execute_tasks):
+                submitted = pool.submit_batch(tasks)
+                for _, job_id in submitted[:3]:
+                    self.wait_for_job(pool, job_id)
+
+            self.assertEqual(submitted[3], ("Invalid question", -1))
+            self.assertEqual(sorted(groups), [1, 2])
+            self.assertEqual(pool.result_store.get(submitted[2][1]), b'{"Kentucky":22.9}')
+
+    def test_reload(self):
+        data = {
+            "task": const.STATE_MEAN,
+            "question": "Percent of adults who engage in no leisure-time physical activity",
+            "state": "Kentucky"
+        }
+        with open("unittests/unittest_nutrition_activity_obesity_usa_subset.csv", encoding="utf-8") as f:
+            csv_data = f.read().replace(",22.9,22.9,", ",32.9,32.9,")
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", encoding="utf-8") as f:
+            f.write(csv_data)
+            f.flush()
+            data_ingestor = DataIngestor(f.name)
+
+        with self.thread_pool(TP_NUM_OF_THREADS="2") as pool:
+            with self.blocked_tasks() as (release, _):
+                _, old_job_id = pool.submit_task(**data)
+                pool.reload(data_ingestor)
+                _, new_job_id = pool.submit_task(**data)
+                release.set()
+
+                self.wait_for_job(pool, old_job_id)
+                self.wait_for_job(pool, new_job_id)
+
+            self.assertIs(pool.data_ingestor, data_ingestor)
+            self.assertEqual(pool.result_store.get(old_job_id), b'{"Kentucky":22.9}')
+            self.assertEqual(pool.result_store.get(new_job_id), b'{"Kentucky":32.9}')
+
+    def test_failed_reload(self):
+        ws.reload_lock.acquire()
+        ws.reload_status = {"status": "reloading"}
+
+        with mock.patch("app.webserver.DataIngestor", side_effect=IndexError("list index out of range")):
+            reload_data_ingestor("unittests/unittest_nutrition_activity_obesity_usa_subset.csv")
+
+        self.assertEqual(ws.reload_status, {"status": "error", "reason": "list index out of range"})
+        self.assertFalse(ws.reload_lock.locked())
+
+        # The served csv changes only once the swap succeeded
+        csv_path = ws.csv_path
+        ws.reload_lock.acquire()
+        with mock.patch("app.webserver.DataIngestor"), \
+                mock.patch.object(ws.tasks_runner, "reload", side_effect=RuntimeError("shut down")):
+            reload_data_ingestor("unittests/unittest_nutrition_activity_obesity_usa_subset.csv")
+
+        self.assertEqual(ws.reload_status, {"status": "error", "reason": "shut down"})
+        self.assertEqual(ws.csv_path, csv_path)
+        ws.reload_status = {"status": "idle"}
+
+    def test_reload_csv_path(self):
+        client = ws.test_client()
+
+        with mock.patch.object(ws, "data_dir", os.path.realpath("unittests")), \
+                mock.patch("app.routes.Thread") as thread:
+            for csv_path in (3, None, ["unittests"]):
+                response = client.post("/api/admin/reload", json={"csv_path": csv_path})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.get_json(), {"status": "error", "reason": "Invalid csv_path"})
+
+            for route in ("/api/admin/reload", "/api/admin/append"):
+                for csv_path in ("/etc/passwd", "unittests/../requirements.txt"):
+                    response = client.post(route, json={"csv_path": csv_path})
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.get_json()["reason"], "csv_path outside the data directory")
+
+            thread.assert_not_called()
+            self.assertFalse(ws.reload_lock.locked())
+
+            csv_path = "unittests/unittest_nutrition_activity_obesity_usa_subset.csv"
+            response = client.post("/api/admin/reload", json={"csv_path": csv_path})
+            self.assertEqual(response.get_json(), {"status": "reloading", "csv_path": csv_path})
+            thread.assert_called_once()
+
+        ws.reload_lock.release()
+        ws.reload_status = {"status": "idle"}
+
+    def test_metrics(self):
+        counter = Counter("requests_total", "Requests.", ("route",))
+        counter.inc('/api/"quoted"')
+        counter.inc('/api/"quoted"')
+        self.assertEqual(counter.render()[2:], ['requests_total{route="/api/\\"quoted\\""} 2'])
+
+        histogram = Histogram("duration_seconds", "Durations.", ("task",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "best5")
+        histogram.observe(0.5, "best5")
+        histogram.observe(5, "best5")
+        self.assertEqual(histogram.render()[2:], [
+            'duration_seconds_bucket{task="best5",le="0.1"} 1',
+            'duration_seconds_bucket{task="best5",le="1"} 2',
+            'duration_seconds_bucket{task="best5",le="+Inf"} 3',
+            'duration_seconds_sum{task="best5"} 5.55',
+            'duration_seconds_count{task="best5"} 3',
+        ])
+
+        data = {
+            "task": const.GLOBAL_MEAN,
+            "question": "Percent of adults who engage in no leisure-time physical activity"
+        }
+
+        with self.thread_pool(TP_NUM_OF_THREADS="2") as pool:
+            self.wait_for_job(pool, pool.submit_task(**data)[1])
+            pool.submit_task(**data)
+
+            lines = pool.render_metrics()
+            runners = [line for line in lines if line.startswith("task_runners{")]
+            self.assertEqual(sum(int(line.split()[1]) for line in runners), 2)
+            self.assertIn('task_queue_depth{lane="global_mean"} 0', lines)
+            self.assertIn("result_cache_hits_total 1", lines)
+            self.assertIn('task_execution_seconds_count{task="global_mean"} 1', lines)
+            self.assertIn('tasks_completed_total{task="global_mean",outcome="done"} 1', lines)
+
+    def test_scheduler(self):
+        scheduler = TaskScheduler({"cheap": 3, "expensive": 1})
+        for index in range(8):
+            scheduler.put(("expensive", index), "expensive")
+        for index in range(6):
+            scheduler.put(("cheap", index), "cheap")
+
+        # Both lanes are backlogged, so the cheap one gets 3 turns for every expensive one
+        lanes = [scheduler.get()[0] for _ in range(8)]
+        self.assertEqual(lanes.count("cheap"), 6)
+        self.assertEqual(lanes.count("expensive"), 2)
+
+        # A higher priority overtakes the other lanes and the earlier entries of its lane
+        scheduler.put(("expensive", "urgent"), "expensive", priority=1)
+        self.assertEqual(scheduler.get(), ("expensive", "urgent"))
+        self.assertEqual(scheduler.get(), ("expensive", 2))
+        self.assertEqual(scheduler.depths(), {"cheap": 0, "expensive": 5})
+
+        # Once closed, the remaining entries are drained before the shutdown signal
+        scheduler.close()
+        self.assertEqual([scheduler.get() for _ in range(5)], [("expensive", index) for index in range(3, 8)])
+        self.assertEqual(scheduler.get(), const.GRACEFUL_SHUTDOWN)
+
+    def test_scheduler_shed(self):
+        scheduler = TaskScheduler({})
+        scheduler.put("low", "a", priority=-1)
+        scheduler.put("normal", "a")
+        scheduler.put("newer low", "b", priority=-1)
+        scheduler.put("high", "b", priority=2)
+
+        # Nothing queued has a lower priority, so nothing is shed
+        self.assertIsNone(scheduler.shed(-1))
+
+        # The most recent entry of the lowest priority goes first
+        self.assertEqual(scheduler.shed(0), "newer low")
+        self.assertEqual(scheduler.shed(0), "low")
+        self.assertIsNone(scheduler.shed(0))
+        self.assertEqual(scheduler.priorities, {0: 1, 2: 1})
+
+        self.assertEqual(scheduler.get(), "high")
+        self.assertEqual(scheduler.shed(1), "normal")
+        self.assertEqual((scheduler.qsize(), scheduler.priorities), (0, {}))
+
+    def test_invalid_priority(self):
+        with self.thread_pool(TP_NUM_OF_THREADS="1") as pool:
+            self.assertEqual(pool.submit_task(task=const.GLOBAL_MEAN, priority="high", question="Percent of adults who engage in no leisure-time physical activity"), ("Invalid priority", -1))
+
+    def test_profile(self):
+        data = {
+            "task": const.STATE_MEAN,
+            "question": "Percent of adults who engage in no leisure-time physical activity",
+            "state": "Kentucky"
+        }
+
+        with self.thread_pool(TP_NUM_OF_THREADS="1") as pool:
+            _, job_id = pool.submit_task(**data)
+            self.wait_for_job(pool, job_id)
+            self.assertIsNone(pool.result_store.get(profile_key(job_id)))
+
+            # A profiled task is computed again rather than served from the cache
+            _, job_id = pool.submit_task(profile=True, **data)
+            self.wait_for_job(pool, job_id)
+            self.assertEqual(pool.result_store.get(job_id), b'{"Kentucky":22.9}')
+            self.assertIn(b"function calls", pool.result_store.get(profile_key(job_id)))
+
+            self.assertEqual(pool.submit_task(profile="yes", **data), ("Invalid profile flag", -1))
+
+            with mock.patch.object(ws, "tasks_runner", pool):
+                client = ws.test_client()
+                self.assertIn("function calls", client.get(f"/api/profile/{job_id}").get_json()["data"])
+                self.assertEqual(client.get("/api/profile/abc").get_json(),
+                                 {"status": "error", "reason": "Invalid job_id"})
+
+                # The profile goes away with the result of its job
+                pool.jobs[job_id] = {"status": "expired"}
+                self.assertEqual(client.get(f"/api/profile/{job_id}").get_json(),
+                                 {"status": "error", "reason": "Result expired"})
+
+        with self.thread_pool(TP_NUM_OF_THREADS="1", TP_PROFILE_SAMPLE_RATE="1") as pool:
+            _, job_id = pool.submit_task(**data)
+            self.wait_for_job(pool, job_id)
+            self.assertIsNotNone(pool.result_store.get(profile_key(job_id)))
+
+    def call_asgi(self, method, path, query_string=b"", body=b""):
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http", "method": method, "path": path, "query_string": query_string,
+            "headers": [(b"content-type", b"application/json")],
+        }
+        asyncio.run(application(scope, receive, send))
+
+        self.assertEqual(sent[0]["status"], 200)
+        return json.loads(sent[1]["body"])
+
+    def test_asgi(self):
+        data = {
+            "question": "Percent of adults who engage in no leisure-time physical activity",
+            "state": "Kentucky"
+        }
+
+        with self.thread_pool(TP_NUM_OF_THREADS="1") as pool:
+            with mock.patch.object(ws, "tasks_runner", pool):
+                # The task routes are served by the Flask app, the polls on the event loop
+                response = self.call_asgi("POST", "/api/state_mean", body=json.dumps(data).encode())
+                self.assertEqual(response["status"], "success")
+
+                response = self.call_asgi("GET", f"/api/get_results/{response['job_id']}", b"wait=5")
+                self.assertEqual(response, {"status": "done", "data": {"Kentucky": 22.9}})
+                self.assertEqual(pool.job_waiters, {})
+
+                response = self.call_asgi("GET", "/api/get_results/100")
+                self.assertEqual(response, {"status": "error", "reason": "Invalid job_id"})
+
+                # The answers that may block on file I/O are built off the event loop
+                threads = []
+
+                def job_result(job_id, parsed_job_id):
+                    threads.append(threading.current_thread())
+                    return b"{}"
+
+                with mock.patch.dict(os.environ, {"LOG_MODE": "sync"}), \
+                        mock.patch("app.asgi.job_result", job_result):
+                    self.call_asgi("GET", "/api/get_results/0")
+                self.assertEqual(len(threads), 1)
+                self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_asgi_cancelled_wait(self):
+        tasks_runner = mock.Mock()
+        tasks_runner.add_job_waiter.return_value = True
+
+        async def cancel_wait():
+            wait = asyncio.ensure_future(asgi_wait_for_job(0, 30))
+            await asyncio.sleep(0.01)
+            wait.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await wait
+
+        with mock.patch.object(ws, "tasks_runner", tasks_runner):
+            asyncio.run(cancel_wait())
+
+        callback = tasks_runner.add_job_waiter.call_args[0][1]
+        tasks_runner.remove_job_waiter.assert_called_once_with(0, callback)
+
+    def test_queue_full(self):
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        with self.thread_pool(TP_NUM_OF_THREADS="1", TP_MAX_QUEUE_DEPTH="2") as pool:
+            with self.blocked_tasks() as (release, started):
+                # The only worker is busy with the first task, the next two fill the queue
+                _, running_job_id = pool.submit_task(task=const.GLOBAL_MEAN, question=question)
+                started.wait(5)
+                _, kept_job_id = pool.submit_task(task=const.STATE_MEAN, question=question, state="Iowa")
+                _, shed_job_id = pool.submit_task(task=const.STATE_MEAN, question=question, state="Kentucky")
+
+                job_ids = len(pool.jobs)
+                with self.assertRaises(QueueFullError) as context:
+                    pool.submit_task(task=const.STATE_MEAN, question=question, state="Louisiana")
+                self.assertGreaterEqual(context.exception.retry_after, 1)
+                self.assertEqual(len(pool.jobs), job_ids)
+
+                # An identical task in flight still shares its result
+                self.assertEqual(pool.submit_task(task=const.GLOBAL_MEAN, question=question)[0], 0)
+
+                # A more urgent task takes the place of the most recent one
+                _, urgent_job_id = pool.submit_task(task=const.STATE_MEAN, question=question, state="Massachusetts", priority=1)
+                self.assertEqual(pool.jobs[shed_job_id], {"status": "error", "reason": "Task shed under load"})
+
+                release.set()
+                for job_id in (running_job_id, kept_job_id, urgent_job_id):
+                    self.wait_for_job(pool, job_id)
+                    self.assertEqual(pool.jobs[job_id]["status"], "done")
+
+            lines = pool.render_metrics()
+            self.assertIn('tasks_rejected_total{task="state_mean",reason="queue_full"} 1', lines)
+            self.assertIn('tasks_rejected_total{task="state_mean",reason="shed"} 1', lines)
+            self.assertEqual(pool.queued, 0)
+
+    def test_job_registry(self):
+        registry = JobRegistry(retention=60)
+        job_ids = [registry.create() for _ in range(6)]
+        self.assertEqual(job_ids, list(range(6)))
+        self.assertEqual(registry.running, 6)
+
+        registry[1] = {"status": "done"}
+        registry[2] = {"status": "error", "reason": "Invalid question"}
+        self.assertEqual(registry[1], {"status": "done"})
+        self.assertEqual(registry[2], {"status": "error", "reason": "Invalid question"})
+        self.assertEqual(registry.running, 4)
+
+        self.assertEqual(registry.page(0, 2), ([(0, "running"), (1, "done")], 2))
+        self.assertEqual(registry.page(2, 10), ([(2, "error"), (3, "running"), (4, "running"), (5, "running")], None))
+        self.assertEqual(registry.page(0, 2, "running"), ([(0, "running"), (3, "running")], 4))
+        self.assertEqual(registry.page(0, 2, "done"), ([(1, "done")], None))
+
+        # The finished jobs expire and, once the oldest ones have, they are cut from the front
+        for job_id in (0, 3, 4):
+            registry[job_id] = {"status": "done"}
+
+        with mock.patch("app.job_registry.time.monotonic", return_value=time.monotonic() + 61):
+            registry.create()
+
+        self.assertEqual(registry.base, 5)
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry[0], {"status": "expired"})
+        self.assertEqual(registry[5], {"status": "running"})
+        self.assertEqual(registry.running, 2)
+        self.assertEqual(registry.page(0, 10), ([(5, "running"), (6, "running")], None))
+
+        with self.assertRaises(KeyError):
+            registry[7]
+
+    def test_async_logging(self):
+        handler = AsyncQueueHandler(queue.Queue(3))
+        handler.addFilter(SamplingFilter(2))
+
+        logger = logging.getLogger("test_async_logging")
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            logger.warning("kept")
+            for job_id in range(4):
+                logger.warning("running %d", job_id, extra={"sampled": True})
+            logger.warning("dropped")
+        finally:
+            logger.removeHandler(handler)
+
+        # One in two sampled records is kept and the records over the queue size are dropped
+        records = [handler.queue.get_nowait() for _ in range(3)]
+        self.assertEqual([record.getMessage() for record in records], ["kept", "running 0", "running 2"])
+        self.assertEqual(handler.dropped, 1)
+
+        # The drops of the server's log queue are exported by /metrics
+        with mock.patch.object(ws_logger, "handlers", [handler]):
+            lines = ws.test_client().get("/metrics").get_data(as_text=True).splitlines()
+        self.assertIn("log_records_dropped_total 1", lines)
+
+    def test_failed_task(self):
+        data = {
+            "task": const.STATE_MEAN,
+            "question": "Percent of adults who engage in no leisure-time physical activity",
+            "state": "Atlantis"
+        }
+
+        with self.thread_pool(TP_NUM_OF_THREADS="1") as pool:
+            _, job_id = pool.submit_task(**data)
+            self.wait_for_job(pool, job_id)
+            self.assertEqual(pool.jobs[job_id]["status"], "error")
+
+            # The runner survives the failure
+            _, job_id = pool.submit_task(**dict(data, state="Kentucky"))
+            self.wait_for_job(pool, job_id)
+            self.assertEqual(pool.jobs[job_id]["status"], "done")
+
 from app import webserver
 webserver.tasks_runner.graceful_shutdown()
\ No newline at end of file